@@ -1,42 +1,35 @@
-import boto3
 import os
 import json
-from slackclient import SlackClient
+import time
+from scotty_common import getClient, getSlackClient, getSlackWorkspaceId, getSlackMember, get_table_source, \
+    list_catalog_tables, is_blacklist_pattern, compile_blacklist_matcher, is_blacklisted
 
 
-def validate_table(table_name):
-    tableExistFlag = False
-    client = boto3.client('dynamodb')
-    paginator = client.get_paginator('list_tables')
-    pages = paginator.paginate()
-    for page in pages:
-        for table in page['TableNames']:
-            if table.lower() == table_name.lower():
-                tableExistFlag = True
-    return tableExistFlag
+# Table names in the catalog are cached at module level, so a comma separated command is validated
+# against one listing and warm invocations reuse it until the TTL expires
+_table_catalog = {
+    'tables': None,
+    'expires': 0
+}
 
 
-def getSlackWorkspaceId(slack_client):
-    id = None
-    response = slack_client.api_call("team.info")
-    # pprint(response)
-    if 'team' in response:
-        id = response['team']['id']
-    return id
+# {lower cased name: table name} of every table in the catalog
+def getTableCatalog(client):
+    now = time.time()
+    if _table_catalog['tables'] is None or now >= _table_catalog['expires']:
+        tables = {}
+        # the same sources as Scotty_TableAccess, listed concurrently, with failed sources left out
+        for table in list_catalog_tables(client):
+            tables[table.lower()] = table
+        _table_catalog['tables'] = tables
+        _table_catalog['expires'] = now + int(os.environ.get('catalogTTL', 300))
+    return _table_catalog['tables']
 
 
-def getSlackMember(slack_client, userId):
-    response = slack_client.api_call("users.list")
-    for member in response['members']:
-        try:
-            if member['id'] == userId:
-                emailValue = member['profile']['email'].split('@')
-                return emailValue[0]
-
-        except KeyError:
-            return None
-
-    return None
+# a plain entry names a table in any source, a qualified one (<account>/<region>/<table>) a single source
+def tableExists(catalog, entry):
+    entry = entry.lower()
+    return entry in catalog or any(get_table_source(name)[2] == entry for name in catalog)
 
 
 def message_handler(message):
@@ -54,72 +47,100 @@ def message_handler(message):
     return error_message
 
 
-def removeBlacklist(client, removeBlacklistData, type, tableName):
-    type = type.replace(" remove ", "_")
+# The blacklist rows keep their entries as a DynamoDB string set in 'data', so adds and removes are
+# atomic ADD/DELETE updates. Rows written by older versions hold a comma joined string instead
+def getBlacklistEntries(item):
+    data = item.get('data', {})
+    if 'SS' in data:
+        return set(data['SS'])
+    if 'S' in data:
+        return set(entry for entry in data['S'].split(',') if entry and entry != 'EMPTY')
+    return set()
+
 
+# convert a row still holding a comma joined string into a string set.
+# Returns False when there is nothing to convert
+def migrateBlacklistRow(client, rowName, tableName):
     row = client.get_item(
         TableName=tableName,
-        Key={'key': {'S': type}}
+        Key={'key': {'S': rowName}}
     )
+    if 'Item' not in row or 'S' not in row['Item'].get('data', {}):
+        return False
 
-    if 'Item' in row:
-        # Turn the string to list to remove the data easily
-        data = row['Item']['data']['S'].split(",")
-        if removeBlacklistData in data:
-            data.remove(removeBlacklistData)
+    entries = getBlacklistEntries(row['Item'])
+    try:
+        if entries:
+            client.update_item(
+                TableName=tableName,
+                Key={'key': {'S': rowName}},
+                UpdateExpression='SET #data = :entries',
+                ConditionExpression='#data = :old',
+                ExpressionAttributeNames={'#data': 'data'},
+                ExpressionAttributeValues={':entries': {'SS': sorted(entries)}, ':old': row['Item']['data']}
+            )
         else:
-            return False
-        # turn it back into a string
-        data = ",".join(data)
+            client.update_item(
+                TableName=tableName,
+                Key={'key': {'S': rowName}},
+                UpdateExpression='REMOVE #data',
+                ConditionExpression='#data = :old',
+                ExpressionAttributeNames={'#data': 'data'},
+                ExpressionAttributeValues={':old': row['Item']['data']}
+            )
+    except client.exceptions.ConditionalCheckFailedException:
+        # converted by a concurrent request
+        pass
+    return True
 
-        # if the row exists then set the value to EMPTY
-        if data == "":
-            data = "EMPTY"
 
-        client.put_item(
-            TableName=tableName,
-            Item={'key': {'S': type}, 'data': {'S': data}}
-        )
-        return True
+# apply an atomic ADD or DELETE of the entries to the row's string set and bump the row's version, which
+# TableAccess uses to revalidate its cached copy. Returns the set of entries that were actually added
+# (not already there) or removed (were there), taken from the set as it was before the update
+def updateBlacklist(client, action, entries, rowName, tableName):
+    entries = set(entries)
+    if action == 'ADD':
+        expression = 'ADD #data :entries, #version :one'
+        condition = 'attribute_not_exists(#data) OR attribute_type(#data, :ss)'
     else:
-        # row doesn't exist yet; therefore no table or use has been blacklisted
-        return False
-
+        expression = 'DELETE #data :entries ADD #version :one'
+        condition = 'attribute_type(#data, :ss)'
 
-def addToBlacklist(client, blacklistData, type, tableName):
-    # get the blacklist for user from dynamoDB
-
-    type = type.replace(" ", "_")
-
-    row = client.get_item(
-        TableName=tableName,
-        Key={'key': {'S': type}}
-    )
-    if 'Item' in row:
-        # if the row exists. "EMPTY" is when the row had data at one point in time but was removed
-        data = row['Item']['data']['S']
-
-        if data.lower() == 'EMPTY':
-            data = blacklistData
-        else:
-            if blacklistData in data.split(","):
-                return False
+    for attempt in range(2):
+        try:
+            response = client.update_item(
+                TableName=tableName,
+                Key={'key': {'S': rowName}},
+                UpdateExpression=expression,
+                ConditionExpression=condition,
+                ExpressionAttributeNames={'#data': 'data', '#version': 'version'},
+                ExpressionAttributeValues={
+                    ':entries': {'SS': sorted(entries)},
+                    ':ss': {'S': 'SS'},
+                    ':one': {'N': '1'}
+                },
+                ReturnValues='UPDATED_OLD'
+            )
+            previous = set(response.get('Attributes', {}).get('data', {}).get('SS', []))
+            if action == 'ADD':
+                return entries - previous
+            return entries & previous
+        except client.exceptions.ConditionalCheckFailedException:
+            # a row in the old string format fails the condition: convert it and try once more.
+            # A DELETE on a row without any entries fails it too, and has nothing to remove
+            if attempt > 0 or not migrateBlacklistRow(client, rowName, tableName):
+                return set()
+    return set()
 
-            data += "," + blacklistData
 
-        client.put_item(
-            TableName=tableName,
-            Item={'key': {'S': type}, 'data': {'S': data}}
-        )
+def removeBlacklist(client, removeBlacklistData, type, tableName):
+    type = type.replace(" remove ", "_")
+    return updateBlacklist(client, 'DELETE', removeBlacklistData, type, tableName)
 
-    else:
-        # if the data row is new or if row was delete
-        client.put_item(
-            TableName=tableName,
-            Item={'key': {'S': type}, 'data': {'S': blacklistData}}
-        )
 
-    return True
+def addToBlacklist(client, blacklistData, type, tableName):
+    type = type.replace(" ", "_")
+    return updateBlacklist(client, 'ADD', blacklistData, type, tableName)
 
 
 def display(client, tableName, type=None):
@@ -130,32 +151,26 @@ def display(client, tableName, type=None):
     else:
         rowName = 'None'
 
-    row = client.get_item(
-        TableName=tableName,
-        Key={'key': {'S': rowName}})
-
     if type == 'user':
-        if 'Item' in row:
-            data = row['Item']['data']['S']
-            if data == 'EMPTY':
-                return message_handler('No users have been blacklisted')
-
-            displayVariable = '\n'.join(data.split(','))
-            displayMessage = 'The users currently blacklisted are:\n' + displayVariable
-            return message_handler(displayMessage)
-        else:
-            return message_handler('No user has been added to the blacklist')
+        row = client.get_item(
+            TableName=tableName,
+            Key={'key': {'S': rowName}})
+        entries = getBlacklistEntries(row.get('Item', {}))
+        if not entries:
+            return message_handler('No users have been blacklisted')
+
+        displayMessage = 'The users currently blacklisted are:\n' + '\n'.join(sorted(entries))
+        return message_handler(displayMessage)
     elif type == 'table':
-        if 'item' in row:
-            data = row['Item']['data']['S']
-            if data == 'EMPTY':
-                return message_handler('No table have been blacklisted')
-
-            displayVariable = '\n'.join(data.split(','))
-            displayMessage = 'The tables currently blacklisted are:\n' + displayVariable
-            return message_handler(displayMessage)
-        else:
-            return message_handler('No table has been added to the blacklist')
+        row = client.get_item(
+            TableName=tableName,
+            Key={'key': {'S': rowName}})
+        entries = getBlacklistEntries(row.get('Item', {}))
+        if not entries:
+            return message_handler('No table have been blacklisted')
+
+        displayMessage = 'The tables currently blacklisted are:\n' + '\n'.join(sorted(entries))
+        return message_handler(displayMessage)
     elif type is None:
         rows = client.batch_get_item(
             RequestItems={
@@ -172,19 +187,17 @@ def display(client, tableName, type=None):
             print("NO USERS OR TABLES has been set")
 
         Data = rows['Responses'][tableName]
-        displayUser = ''
-        displayTable = ''
-        user_data='EMPTY'
-        table_data='EMPTY'
+        user_data = set()
+        table_data = set()
         for data in Data:
             if data['key']['S'].lower() == 'blacklist_user':
-                user_data = data['data']['S']
-                displayUser = 'Users currently blacklisted are:\n' + '\n'.join(data['data']['S'].split(','))
+                user_data = getBlacklistEntries(data)
             elif data['key']['S'].lower() == 'blacklist_table':
-                table_data = data['data']['S']
-                displayTable = 'Tables currently blacklisted are:\n' + '\n'.join(data['data']['S'].split(','))
-        if user_data == 'EMPTY' and table_data == 'EMPTY':
+                table_data = getBlacklistEntries(data)
+        if not user_data and not table_data:
             return message_handler('No Users or Tables have been blacklisted')
+        displayUser = 'Users currently blacklisted are:\n' + '\n'.join(sorted(user_data)) if user_data else ''
+        displayTable = 'Tables currently blacklisted are:\n' + '\n'.join(sorted(table_data)) if table_data else ''
         displayMessage = displayUser + "\n\n" + displayTable
         return message_handler(displayMessage)
 
@@ -193,17 +206,18 @@ def help():
     message = "Blacklist has 3 different functionality: adding users or tables to the blacklist, removing users or tables from the blacklist and displaying all users and tables currently blacklisted." \
               "\n\n*_Blacklist Command_*" \
               "\n\tblacklist user <@slack user>" \
-              "\n\tblacklist table <table name>" \
-              "\n\tblacklist remove table <table name>" \
+              "\n\tblacklist table <table name, pattern>" \
+              "\n\tblacklist remove table <table name, pattern>" \
               "\n\tblacklist remove user <@slack user>" \
-              "\n\tblacklist show or blacklist show user or blacklist show table"
+              "\n\tblacklist show or blacklist show user or blacklist show table" \
+              "\n\nSeveral tables can be given as a comma separated list, and * or ? patterns (e.g. *-pii, prod-billing-*) blacklist every matching table."
     return message_handler(message)
 
 
 def lambda_handler(event, context):
     print(json.dumps(event))
     userId = ""
-    client = boto3.client('dynamodb')
+    client = getClient('dynamodb')
     tableName = os.environ['dynamoDBTable']
 
     # Find who's requesting the to black list
@@ -211,7 +225,7 @@ def lambda_handler(event, context):
     usersList = [users.strip() for users in usersList]
 
     # find who they are? Get the slack account id
-    sc = SlackClient(os.environ['api_token'])
+    sc = getSlackClient()
     workspace_id = getSlackWorkspaceId(sc)
     userId_split = event['userId'].split(":")
     if userId_split[1] == workspace_id:
@@ -223,7 +237,7 @@ def lambda_handler(event, context):
         if event["inputTranscript"].lower() == 'blacklist help':
             return help()
         type = event['currentIntent']['slotDetails']['types']['originalValue']
-        command = event['inputTranscript'].split(type)
+        command = event['inputTranscript'].split(type, 1)
         # what type of blacklisting they're attempting
         requestType = {'blacklist user', 'blacklist remove user', 'blacklist table', 'blacklist remove table',
                        "blacklist show"}
@@ -241,36 +255,50 @@ def lambda_handler(event, context):
                 if id is None:
                     return message_handler("User is not a member of this slack workspace.")
 
-                if addToBlacklist(client, id, blacklistRequestType, tableName) is False:
+                if not addToBlacklist(client, [id], blacklistRequestType, tableName):
                     return message_handler("This user has already been blacklisted.")
                 else:
                     return message_handler(id + " has been blacklisted.")
 
             if blacklistRequestType.lower() == 'blacklist remove user':
-                if removeBlacklist(client, id, blacklistRequestType, tableName) is False:
+                # a user unknown to the workspace cannot be in the blacklist
+                if id is None or not removeBlacklist(client, [id], blacklistRequestType, tableName):
                     return message_handler("The user has not been blacklisted")
                 else:
                     return message_handler(id + " has been removed from the blacklist")
 
         elif blacklistRequestType.lower() == 'blacklist table' or blacklistRequestType.lower() == 'blacklist remove table':
-            blacklistTable = command[1].strip()
-            validatedTable = validate_table(blacklistTable)
-
-            if validatedTable is True:
-                if blacklistRequestType.lower() == "blacklist table":
-                    if addToBlacklist(client, blacklistTable, blacklistRequestType, tableName) is False:
-                        return message_handler("This table has already been blacklisted.")
-                    else:
-                        return message_handler(blacklistTable + " has been blacklisted.")
-
-                if blacklistRequestType.lower() == 'blacklist remove table':
-                    if removeBlacklist(client, blacklistTable, blacklistRequestType, tableName) is False:
-                        return message_handler("The table has not been blacklisted")
-                    else:
-                        return message_handler(blacklistTable + " has been removed from the blacklist")
-            else:
-
-                return message_handler(blacklistTable + " Does not exist in dynamoDB.")
+            blacklistTables = [entry.strip() for entry in command[1].split(',') if entry.strip()]
+            if not blacklistTables:
+                return message_handler("Please enter a table name or pattern.")
+
+            if blacklistRequestType.lower() == "blacklist table":
+                catalog = getTableCatalog(client)
+                missing = [entry for entry in blacklistTables
+                           if not is_blacklist_pattern(entry) and not tableExists(catalog, entry)]
+                if missing:
+                    return message_handler(", ".join(missing) + " Does not exist in dynamoDB.")
+
+                added = addToBlacklist(client, blacklistTables, blacklistRequestType, tableName)
+                if not added:
+                    return message_handler("This table has already been blacklisted." if len(blacklistTables) == 1
+                                           else "These tables have already been blacklisted.")
+
+                # evaluate the new entries against the catalog in one pass to report what they cover
+                matcher = compile_blacklist_matcher(added)
+                matched = [table for table in catalog.values() if is_blacklisted(matcher, table)]
+                message = ", ".join(sorted(added)) + (" has" if len(added) == 1 else " have") + " been blacklisted."
+                if any(is_blacklist_pattern(entry) for entry in added):
+                    message += " (%d existing table%s matched)" % (len(matched), 's' if len(matched) != 1 else '')
+                return message_handler(message)
+
+            if blacklistRequestType.lower() == 'blacklist remove table':
+                removed = removeBlacklist(client, blacklistTables, blacklistRequestType, tableName)
+                if not removed:
+                    return message_handler("The table has not been blacklisted")
+                else:
+                    return message_handler(", ".join(sorted(removed)) + (" has" if len(removed) == 1 else " have") +
+                                           " been removed from the blacklist")
 
         elif blacklistRequestType.lower() == "blacklist show":
             displayType = command[1].strip().lower()
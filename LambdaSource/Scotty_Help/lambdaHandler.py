@@ -1,5 +1,5 @@
-from slackclient import SlackClient
 import os
+from scotty_common import getSlackClient, getSlackWorkspaceId, getSlackMember
 
 
 def message_handler(message):
@@ -36,10 +36,11 @@ def blacklistHelp():
     message = "Using the blacklist command, you can add or remove users or tables to/from the blacklist, or show the current blacklist." \
               "\n\n*_Blacklist Command_*" \
               "\n\tblacklist user <@slack user>" \
-              "\n\tblacklist table <table name>" \
-              "\n\tblacklist remove table <table name>" \
+              "\n\tblacklist table <table name, pattern>" \
+              "\n\tblacklist remove table <table name, pattern>" \
               "\n\tblacklist remove user <@slack user>" \
-              "\n\tblacklist show or blacklist show user or blacklist show table"
+              "\n\tblacklist show or blacklist show user or blacklist show table" \
+              "\n\nSeveral tables can be given as a comma separated list, and * or ? patterns (e.g. *-pii, prod-billing-*) blacklist every matching table."
     return message
 
 def tableAccessHelp():
@@ -70,35 +71,11 @@ def tableAccessHelp():
     return message
 
 
-def getSlackWorkspaceId(slack_client):
-    id = None
-    response = slack_client.api_call("team.info")
-    # pprint(response)
-    if 'team' in response:
-        id = response['team']['id']
-    return id
-
-
-def getSlackMember(slack_client, userId):
-    response = slack_client.api_call("users.list")
-    # pprint(response)
-    for member in response['members']:
-        try:
-            if member['id'] == userId:
-                emailValue = member['profile']['email'].split('@')
-                return emailValue[0]
-
-        except KeyError:
-            return None
-
-    return None
-
-
 def lambda_handler(event, context):  # event, context
 
     request = event['inputTranscript']
 
-    slack_client = SlackClient(os.environ['api_token'])
+    slack_client = getSlackClient()
 
     workspace_id = getSlackWorkspaceId(slack_client)
 
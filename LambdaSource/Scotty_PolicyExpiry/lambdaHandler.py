@@ -0,0 +1,149 @@
+import boto3
+import os
+import json
+import re
+import time
+from datetime import datetime
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+
+
+# AWS clients are created lazily once per container and reused by warm invocations
+_clients = {}
+_client_config = Config(max_pool_connections=20, retries={'max_attempts': 10})
+
+
+def getClient(service):
+    if service not in _clients:
+        _clients[service] = boto3.client(service, config=_client_config)
+    return _clients[service]
+
+
+# detach a policy from everything it is attached to, delete its non-default versions and then the policy.
+# A policy that is already gone counts as revoked, so replayed stream records are harmless. Any other
+# IAM error is logged and returns None: the policy keeps its past date and the nightly sweep retries it
+def revokePolicy(iam, policyArn):
+    try:
+        paginator = iam.get_paginator('list_entities_for_policy')
+        for page in paginator.paginate(PolicyArn=policyArn):
+            for group in page['PolicyGroups']:
+                iam.detach_group_policy(GroupName=group['GroupName'], PolicyArn=policyArn)
+            for user in page['PolicyUsers']:
+                iam.detach_user_policy(UserName=user['UserName'], PolicyArn=policyArn)
+            for role in page['PolicyRoles']:
+                iam.detach_role_policy(RoleName=role['RoleName'], PolicyArn=policyArn)
+
+        versions = iam.list_policy_versions(PolicyArn=policyArn)['Versions']
+        for version in versions:
+            if not version['IsDefaultVersion']:
+                iam.delete_policy_version(PolicyArn=policyArn, VersionId=version['VersionId'])
+
+        iam.delete_policy(PolicyArn=policyArn)
+        print('Revoked %s' % policyArn)
+    except iam.exceptions.NoSuchEntityException:
+        print('%s is already revoked' % policyArn)
+    except iam.exceptions.ClientError as e:
+        print('Could not revoke %s: %s' % (policyArn, e))
+        return None
+    return policyArn
+
+
+# revoke the expired policies of one group one after another; groups are revoked in parallel
+def revokeGroupPolicies(iam, policyArns):
+    return [revokePolicy(iam, policyArn) for policyArn in policyArns]
+
+
+# revoke {group: [policy arns]} with one worker per group
+def revokePolicies(policiesByGroup):
+    iam = getClient('iam')
+    revoked = []
+    if not policiesByGroup:
+        return revoked
+    workers = min(len(policiesByGroup), int(os.environ.get('expiryWorkers', 8)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(revokeGroupPolicies, iam, sorted(policyArns))
+                   for policyArns in policiesByGroup.values()]
+        for future in futures:
+            revoked.extend(policyArn for policyArn in future.result() if policyArn is not None)
+    return revoked
+
+
+# policy expiry items that DynamoDB TTL removed from the grant index
+def getExpiredFromStream(records):
+    policiesByGroup = {}
+    for record in records:
+        if record.get('eventName') != 'REMOVE':
+            continue
+        # items deleted by the sweep below were revoked already; only TTL deletions are acted on
+        if record.get('userIdentity', {}).get('principalId') != 'dynamodb.amazonaws.com':
+            continue
+        item = record['dynamodb'].get('OldImage', {})
+        if not item.get('group', {}).get('S', '').startswith('policy#'):
+            continue
+        policiesByGroup.setdefault(item['policyGroup']['S'], set()).add(item['policyArn']['S'])
+    return policiesByGroup
+
+
+# DynamoDB TTL can take a while to delete expired items, so a schedule just after midnight also
+# finds the policy expiry items whose TTL has passed
+def getExpiredFromIndex(client, tableName):
+    policiesByGroup = {}
+    keys = []
+    paginator = client.get_paginator('scan')
+    pages = paginator.paginate(
+        TableName=tableName,
+        FilterExpression='begins_with(#group, :policy) AND #ttl <= :now',
+        ExpressionAttributeNames={'#group': 'group', '#ttl': 'ttl'},
+        ExpressionAttributeValues={':policy': {'S': 'policy#'}, ':now': {'N': str(int(time.time()))}}
+    )
+    for page in pages:
+        for item in page['Items']:
+            policiesByGroup.setdefault(item['policyGroup']['S'], set()).add(item['policyArn']['S'])
+            keys.append({'group': item['group'], 'grant': item['grant']})
+    return policiesByGroup, keys
+
+
+# dated grant policies are named <YYYY-MM-DD>-<group>[-<part>] by Scotty_TableAccess
+DATED_POLICY_NAME = re.compile(r'^(\d{4}-\d{2}-\d{2})-(.+?)(?:-\d+)?$')
+
+
+# every local dated policy whose grant date has passed, with or without an expiry item: this also finds
+# the policies granted before the grant index existed and those whose expiry item could not be written
+def getExpiredFromPolicies(iam):
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    policiesByGroup = {}
+    paginator = iam.get_paginator('list_policies')
+    for page in paginator.paginate(Scope='Local'):
+        for policy in page['Policies']:
+            match = DATED_POLICY_NAME.match(policy['PolicyName'])
+            if match and match.group(1) < today:
+                policiesByGroup.setdefault(match.group(2), set()).add(policy['Arn'])
+    return policiesByGroup
+
+
+def deleteExpiryItems(client, tableName, keys):
+    for start in range(0, len(keys), 25):
+        pending = {tableName: [{'DeleteRequest': {'Key': key}} for key in keys[start:start + 25]]}
+        delay = 0.1
+        while pending:
+            response = client.batch_write_item(RequestItems=pending)
+            pending = response.get('UnprocessedItems')
+            if pending:
+                time.sleep(delay)
+                delay *= 2
+
+
+def lambda_handler(event, context):
+    print(json.dumps(event))
+    if 'Records' in event:
+        revoked = revokePolicies(getExpiredFromStream(event['Records']))
+    else:
+        client = getClient('dynamodb')
+        tableName = os.environ['grantIndexTable']
+        policiesByGroup, keys = getExpiredFromIndex(client, tableName)
+        for group, policyArns in getExpiredFromPolicies(getClient('iam')).items():
+            policiesByGroup.setdefault(group, set()).update(policyArns)
+        revoked = revokePolicies(policiesByGroup)
+        deleteExpiryItems(client, tableName, keys)
+    print('%d expired polic%s revoked' % (len(revoked), 'ies' if len(revoked) != 1 else 'y'))
+    return revoked
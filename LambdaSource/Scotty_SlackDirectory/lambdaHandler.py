@@ -0,0 +1,105 @@
+import os
+import json
+import time
+from scotty_common import getClient, getSlackClient, iterSlackMembers, getMemberUsername, getDirectoryShard, \
+    DIRECTORY_KEY, DIRECTORY_SHARDS
+
+
+# number of attribute updates sent in a single update_item call
+UPDATE_CHUNK = 50
+
+
+# return {slack id: username} for every active member that has an email
+def getSlackMembers(slack_client):
+    members = {}
+    for member in iterSlackMembers(slack_client):
+        username = getMemberUsername(member)
+        if member.get('deleted') or username is None:
+            continue
+        members[member['id']] = username
+    return members
+
+
+# read one directory shard currently stored in the config table
+def getStoredDirectory(client, tableName, shard):
+    row = client.get_item(
+        TableName=tableName,
+        Key={'key': {'S': shard}}
+    )
+    if 'Item' not in row:
+        return None
+    return {userId: value['S'] for userId, value in row['Item'].get('data', {}).get('M', {}).items()}
+
+
+# write only the entries of a shard that changed since the stored copy
+def updateDirectory(client, tableName, shard, changed, removed):
+    updates = [('SET', userId, username) for userId, username in changed.items()]
+    updates += [('REMOVE', userId, None) for userId in removed]
+
+    for start in range(0, len(updates), UPDATE_CHUNK):
+        chunk = updates[start:start + UPDATE_CHUNK]
+        names = {'#data': 'data', '#updated': 'updated'}
+        values = {':updated': {'N': str(int(time.time()))}}
+        setClauses = ['#updated = :updated']
+        removeClauses = []
+        for i, (action, userId, username) in enumerate(chunk):
+            names['#u%d' % i] = userId
+            if action == 'SET':
+                values[':u%d' % i] = {'S': username}
+                setClauses.append('#data.#u%d = :u%d' % (i, i))
+            else:
+                removeClauses.append('#data.#u%d' % i)
+
+        expression = 'SET ' + ', '.join(setClauses)
+        if removeClauses:
+            expression += ' REMOVE ' + ', '.join(removeClauses)
+        client.update_item(
+            TableName=tableName,
+            Key={'key': {'S': shard}},
+            UpdateExpression=expression,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+
+
+# refresh the Slack ID -> username directory kept in Scotty_Config
+def refreshDirectory(client, slack_client, tableName):
+    shards = {}
+    for userId, username in getSlackMembers(slack_client).items():
+        shards.setdefault(getDirectoryShard(userId), {})[userId] = username
+
+    created = changedCount = removedCount = 0
+    for number in range(DIRECTORY_SHARDS):
+        shard = DIRECTORY_KEY + '#%02d' % number
+        members = shards.get(shard, {})
+        stored = getStoredDirectory(client, tableName, shard)
+
+        if stored is None:
+            client.put_item(
+                TableName=tableName,
+                Item={
+                    'key': {'S': shard},
+                    'data': {'M': {userId: {'S': username} for userId, username in members.items()}},
+                    'updated': {'N': str(int(time.time()))}
+                }
+            )
+            created += 1
+            continue
+
+        changed = {userId: username for userId, username in members.items() if stored.get(userId) != username}
+        removed = [userId for userId in stored if userId not in members]
+        if changed or removed:
+            updateDirectory(client, tableName, shard, changed, removed)
+        changedCount += len(changed)
+        removedCount += len(removed)
+
+    # the row the directory was kept in before it was split into shards is no longer read by anything
+    client.delete_item(TableName=tableName, Key={'key': {'S': DIRECTORY_KEY}})
+    print('Slack directory refreshed: %d shards created, %d changed, %d removed' % (created, changedCount, removedCount))
+
+
+def lambda_handler(event, context):
+    print(json.dumps(event))
+    client = getClient('dynamodb')
+    slack_client = getSlackClient()
+    refreshDirectory(client, slack_client, os.environ['dynamoDBTable'])
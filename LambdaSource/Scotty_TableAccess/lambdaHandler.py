@@ -1,13 +1,17 @@
-import boto3
 import os
 import json
 import botocore.errorfactory
 import re
-from datetime import date, datetime
+import time
+import bisect
+import calendar
+from datetime import date, datetime, timedelta
 from dateutil.parser import parse
-from botocore.vendored import requests
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
-from slackclient import SlackClient
+from scotty_common import getClient, getSlackClient, getAccountContext, getSlackWorkspaceId, getSlackMember, \
+    get_catalog_name, get_table_source, list_catalog_tables, compile_blacklist_matcher, is_blacklisted
 
 
 def get_policy_template():
@@ -41,31 +45,6 @@ def get_policy_template():
     }
 
 
-def getSlackWorkspaceId(slack_client):
-    id = None
-    response = slack_client.api_call("team.info")
-    # pprint(response)
-    if 'team' in response:
-        id = response['team']['id']
-    return id
-
-
-# This method check if the user email and parses it for the username if user doesnt not exist then it return None
-def getSlackMember(slack_client, userId):
-    response = slack_client.api_call("users.list")
-    # pprint(response)
-    for member in response['members']:
-        try:
-            if member['id'] == userId:
-                emailValue = member['profile']['email'].split('@')
-                return emailValue[0]
-
-        except KeyError:
-            return None
-
-    return None
-
-
 # This method is called to get the iam team name the user is part of
 # If the user is not in a team, it returns the iam user account
 def getGroupIdentity(iam, name):
@@ -83,76 +62,398 @@ def getGroupIdentity(iam, name):
     return name
 
 
-# if the provided table exists, create a policy or up-issue existing policy.
-# otherwise, just return a template of the policy
-def create_policy(iam, tableList, date, group, tableExistFlag=False):
-    # Get the account ID from STS
-    sts_client = boto3.client('sts')
-    AccountId = sts_client.get_caller_identity()['Account']
-    Region = os.environ['AWS_REGION']
-    policy = None
-    status = False
-    existingAccess = ''
-    resource_list = []
+# canonical resource list for a set of tables: both ARNs of every table, de-duplicated and sorted
+def get_table_resources(tables):
+    resources = set()
+    for table in tables:
+        resources.add(get_table_arn(table))
+        resources.add(get_table_arn(table) + '/*')
+    return sorted(resources)
+
+
+# the sorted table names granted by a list of resource ARNs
+def get_tables_from_resources(resources):
+    if isinstance(resources, str):
+        resources = [resources]
+    tables = set()
+    for resource in resources:
+        arn = resource.split(':', 5)
+        if len(arn) == 6 and arn[2] == 'dynamodb' and arn[5].startswith('table/') and not resource.endswith('/*'):
+            tables.add(get_catalog_name(arn[4], arn[3], arn[5][len('table/'):]))
+    return sorted(tables)
 
+
+def build_policy_document(tables):
     policy_template = get_policy_template()
+    policy_template['Statement'][0]['Resource'] = get_table_resources(tables)
+    return policy_template
 
-    for table in tableList:
-        resource_list.append('arn:aws:dynamodb:' + Region + ':' + AccountId + ':' + "table/" + table)
-        resource_list.append('arn:aws:dynamodb:' + Region + ':' + AccountId + ':' + "table/" + table + '/*')
 
-    policy_template['Statement'][0]['Resource'] = resource_list
-    print(json.dumps(policy_template))
+# IAM counts managed policy size without whitespace, so documents are sent in compact form
+POLICY_SIZE_LIMIT = 6144
+# most numbered policies a single grant date is split into (<date>-<group>, <date>-<group>-2, ...)
+MAX_POLICY_PARTS = int(os.environ.get('maxPolicyParts', 5))
 
-    policyName = date + '-' + group
 
-    if tableExistFlag:
+def serialize_policy_document(document):
+    return json.dumps(document, separators=(',', ':'))
+
+
+def policy_document_size(tables):
+    return len(serialize_policy_document(build_policy_document(tables)))
+
+
+# characters a table adds to the document: both of its quoted ARNs and their separating commas
+def table_resource_size(table):
+    arn = get_table_arn(table)
+    return len(json.dumps(arn)) + len(json.dumps(arn + '/*')) + 2
+
+
+def get_policy_part_name(date, group, part):
+    policyName = date + '-' + group
+    if part > 1:
+        policyName += '-' + str(part)
+    return policyName
+
+
+# policy documents keyed by (policy ARN, default version ID). A version never changes once created,
+# so a cached document stays valid until the policy gets a new default version
+_policy_documents = {}
+POLICY_CACHE_SIZE = 256
+
+
+# return the default version's document of a policy returned by get_policy, from the cache when possible.
+# Returns (document, calls)
+def get_default_policy_document(iam, existing_policy):
+    key = (existing_policy['Policy']['Arn'], existing_policy['Policy']['DefaultVersionId'])
+    # another thread can clear the cache at any point: the lookup and the store are single (atomic) dict
+    # operations, and the document is returned from a local variable rather than looked up again
+    document = _policy_documents.get(key)
+    if document is not None:
+        return document, 0
+
+    existing_policy_version = iam.get_policy_version(
+        PolicyArn=key[0],
+        VersionId=key[1]
+    )
+    document = existing_policy_version['PolicyVersion']['Document']
+    if len(_policy_documents) >= POLICY_CACHE_SIZE:
+        _policy_documents.clear()
+    _policy_documents[key] = document
+    return document, 1
+
+
+# read the tables of every existing numbered policy for the grant date, stopping at the first missing part.
+# Returns ([{'name', 'arn', 'tables', 'policy'}], calls)
+def get_policy_parts(iam, date, group):
+    parts = []
+    calls = 0
+    for part in range(1, MAX_POLICY_PARTS + 1):
+        policyName = get_policy_part_name(date, group, part)
+        policyArn = getAccountContext()['PolicyArnPrefix'] + policyName
+        calls += 1
         try:
+            existing_policy = iam.get_policy(PolicyArn=policyArn)
+        except iam.exceptions.NoSuchEntityException:
+            break
+        document, documentCalls = get_default_policy_document(iam, existing_policy)
+        calls += documentCalls
+        currentResource = document['Statement'][0]['Resource']
+        parts.append({
+            'name': policyName,
+            'arn': policyArn,
+            'tables': get_tables_from_resources(currentResource),
+            'policy': existing_policy
+        })
+    return parts, calls
+
+
+# pack the new tables into the existing parts first (first fit, by document size) and then into as
+# few new parts as needed. Returns the list of table lists per part, existing parts first
+def pack_policy_tables(existingParts, newTables):
+    packed = [list(part) for part in existingParts]
+    sizes = [policy_document_size(part) for part in packed]
+    emptySize = policy_document_size([])
+
+    for table in sorted(newTables):
+        tableSize = table_resource_size(table)
+        for i in range(len(packed)):
+            if sizes[i] + tableSize <= POLICY_SIZE_LIMIT:
+                packed[i].append(table)
+                sizes[i] += tableSize
+                break
+        else:
+            if emptySize + tableSize > POLICY_SIZE_LIMIT:
+                raise ValueError('Table name %s is too long to fit in a policy' % table)
+            packed.append([table])
+            sizes.append(emptySize + tableSize)
+    return packed
+
+
+# set the default version of an existing policy to the given document. Old versions are only listed
+# and pruned when IAM reports the 5 version limit, and then all non-default versions are removed
+# so the following grants do not need to prune again. Returns (policy version, calls)
+def put_policy_version(iam, policyArn, document):
+    calls = 1
+    try:
+        policy = iam.create_policy_version(PolicyArn=policyArn, PolicyDocument=document, SetAsDefault=True)
+    except iam.exceptions.LimitExceededException:
+        calls += 1
+        versions = iam.list_policy_versions(PolicyArn=policyArn)['Versions']
+        for version in versions:
+            if not version['IsDefaultVersion']:
+                calls += 1
+                iam.delete_policy_version(PolicyArn=policyArn, VersionId=version['VersionId'])
+        calls += 1
+        policy = iam.create_policy_version(PolicyArn=policyArn, PolicyDocument=document, SetAsDefault=True)
+    return policy, calls
+
+
+# IAM attaches at most this many managed policies to a group (or user), 10 unless the quota was raised
+GROUP_POLICY_LIMIT = int(os.environ.get('groupPolicyLimit', 10))
+
+
+class PolicyLimitError(ValueError):
+    pass
+
+
+# ARNs of the managed policies attached to the group, or to the IAM user of that name when there is no such group
+def get_attached_policy_arns(iam, group):
+    try:
+        pages = list(iam.get_paginator('list_attached_group_policies').paginate(GroupName=group))
+    except iam.exceptions.NoSuchEntityException:
+        pages = list(iam.get_paginator('list_attached_user_policies').paginate(UserName=group))
+    return set(policy['PolicyArn'] for page in pages for policy in page['AttachedPolicies'])
+
+
+# the existing parts of a grant that are not attached (e.g. left over by a failed attach), after checking that
+# they and the partCount - len(parts) parts still to be created fit in the group's managed policy limit
+def get_unattached_parts(group, parts, partCount, attached):
+    unattached = [part['policy'] for part in parts[:partCount] if part['arn'] not in attached]
+    total = len(attached) + len(unattached) + max(0, partCount - len(parts))
+    if total > GROUP_POLICY_LIMIT:
+        raise PolicyLimitError('%s would need %d attached policies, more than the limit of %d' %
+                               (group, total, GROUP_POLICY_LIMIT))
+    return unattached
+
+
+# make the numbered policies of the grant date cover at least the given tables, with as few IAM calls as possible:
+#   - existing parts are only versioned when the tables packed into them changed
+#   - new parts are created only when the existing ones are full
+# Returns (policies to attach: created or not yet attached, last written policy, existingTables, calls)
+def put_policy_tables(iam, date, group, tables, attached):
+    parts, calls = get_policy_parts(iam, date, group)
+    existingTables = sorted(set(table for part in parts for table in part['tables']))
+
+    newTables = set(tables) - set(existingTables)
+    if not newTables:
+        # every requested table is already granted, no new version needed
+        unattached = get_unattached_parts(group, parts, len(parts), attached)
+        return unattached, parts[0]['policy'] if parts else None, existingTables, calls
+
+    packed = pack_policy_tables([part['tables'] for part in parts], newTables)
+    if len(packed) > MAX_POLICY_PARTS:
+        raise ValueError('%d tables need %d policies, more than the limit of %d' %
+                         (len(existingTables) + len(newTables), len(packed), MAX_POLICY_PARTS))
+    unattached = get_unattached_parts(group, parts, len(packed), attached)
+
+    created = []
+    policy = None
+    for i, partTables in enumerate(packed):
+        if i < len(parts):
+            if len(partTables) == len(parts[i]['tables']):
+                continue
+            policy, versionCalls = put_policy_version(
+                iam, parts[i]['arn'], serialize_policy_document(build_policy_document(partTables)))
+            calls += versionCalls
+        else:
+            calls += 1
             policy = iam.create_policy(
-                PolicyName=policyName,
-                PolicyDocument=json.dumps(policy_template)
-            )
-            status = True
-        except botocore.errorfactory.ClientError:
-            existing_policy = iam.get_policy(
-                PolicyArn='arn:aws:iam::' + AccountId + ':policy/' + policyName
+                PolicyName=get_policy_part_name(date, group, i + 1),
+                PolicyDocument=serialize_policy_document(build_policy_document(partTables))
             )
+            created.append(policy)
+    return created + unattached, policy, existingTables, calls
 
-            policyVersionsList = iam.list_policy_versions(
-                PolicyArn=existing_policy['Policy']['Arn']
-            )
 
-            if len(policyVersionsList['Versions']) == 5:
-                iam.delete_policy_version(
-                    PolicyArn=existing_policy['Policy']['Arn'],
-                    VersionId=policyVersionsList['Versions'][4]['VersionId']
-                )
+# policyMode "dated" (default) keeps one policy per group and expiry date (<date>-<group>), revoked by
+# Scotty_PolicyExpiry. policyMode "conditioned" keeps a single policy per group (Scotty-<group>) with one
+# statement per expiry date, guarded by an aws:CurrentTime condition so IAM enforces the expiry itself
+POLICY_MODE = os.environ.get('policyMode', 'dated')
+CONDITIONED_POLICY_PREFIX = 'Scotty-'
 
-            existing_policy_version = iam.get_policy_version(
-                PolicyArn=existing_policy['Policy']['Arn'],
-                VersionId=existing_policy['Policy']['DefaultVersionId']
-            )
 
-            currentResource = existing_policy_version['PolicyVersion']['Document']['Statement'][0]['Resource']
-            for i in range(0, len(currentResource), 2):
-                existingAccess += currentResource[i][
-                                  len('arn:aws:dynamodb:' + Region + ':' + AccountId + ':' + "table/"):] + ","
-            existingAccess = "\n".join(existingAccess.split(",")[:-1])
-
-            for item in resource_list:
-                if item not in currentResource:
-                    currentResource.append(item)
-            policy_template['Statement'][0]['Resource'] = currentResource
-            policy = iam.create_policy_version(
-                PolicyArn=existing_policy['Policy']['Arn'],
-                PolicyDocument=json.dumps(policy_template),
-                SetAsDefault=True
+def get_conditioned_policy_name(group, part):
+    policyName = CONDITIONED_POLICY_PREFIX + group
+    if part > 1:
+        policyName += '-' + str(part)
+    return policyName
+
+
+# one statement granting the tables until the end of the date (UTC)
+def build_grant_statement(date, tables):
+    statement = get_policy_template()['Statement'][0]
+    statement['Sid'] = 'Until' + date.replace('-', '')
+    statement['Resource'] = get_table_resources(tables)
+    statement['Condition'] = {
+        'DateLessThan': {
+            'aws:CurrentTime': (datetime.strptime(date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        }
+    }
+    return statement
+
+
+def build_conditioned_policy_document(grants):
+    policy_template = get_policy_template()
+    policy_template['Statement'] = [build_grant_statement(grantDate, grants[grantDate]) for grantDate in sorted(grants)]
+    return policy_template
+
+
+# {date: set of tables} granted by the statements of a conditioned policy document
+def get_grants_from_document(document):
+    grants = {}
+    for statement in document['Statement']:
+        sid = statement.get('Sid', '')
+        if not re.match(r'^Until\d{8}$', sid):
+            continue
+        grantDate = sid[5:9] + '-' + sid[9:11] + '-' + sid[11:13]
+        grants.setdefault(grantDate, set()).update(get_tables_from_resources(statement['Resource']))
+    return grants
+
+
+# read the grants of every existing numbered conditioned policy of the group, stopping at the first missing part.
+# Returns ([{'name', 'arn', 'grants', 'policy'}], calls)
+def get_conditioned_policy_parts(iam, group):
+    parts = []
+    calls = 0
+    for part in range(1, MAX_POLICY_PARTS + 1):
+        policyName = get_conditioned_policy_name(group, part)
+        policyArn = getAccountContext()['PolicyArnPrefix'] + policyName
+        calls += 1
+        try:
+            existing_policy = iam.get_policy(PolicyArn=policyArn)
+        except iam.exceptions.NoSuchEntityException:
+            break
+        document, documentCalls = get_default_policy_document(iam, existing_policy)
+        calls += documentCalls
+        parts.append({
+            'name': policyName,
+            'arn': policyArn,
+            'grants': get_grants_from_document(document),
+            'policy': existing_policy
+        })
+    return parts, calls
+
+
+# detach and delete a conditioned part whose statements have all expired. Returns the number of IAM calls
+def delete_conditioned_policy(iam, policyArn):
+    calls = 0
+    paginator = iam.get_paginator('list_entities_for_policy')
+    for page in paginator.paginate(PolicyArn=policyArn):
+        calls += 1
+        for entity in page['PolicyGroups']:
+            iam.detach_group_policy(GroupName=entity['GroupName'], PolicyArn=policyArn)
+            calls += 1
+        for entity in page['PolicyUsers']:
+            iam.detach_user_policy(UserName=entity['UserName'], PolicyArn=policyArn)
+            calls += 1
+
+    calls += 1
+    for version in iam.list_policy_versions(PolicyArn=policyArn)['Versions']:
+        if not version['IsDefaultVersion']:
+            iam.delete_policy_version(PolicyArn=policyArn, VersionId=version['VersionId'])
+            calls += 1
+    iam.delete_policy(PolicyArn=policyArn)
+    print('Deleted expired policy %s' % policyArn)
+    return calls + 1
+
+
+# merge the grant into the group's conditioned policies: statements of past dates are pruned, the new
+# tables are first-fit packed into the existing parts by document size, and only changed parts are versioned.
+# IAM rejects a policy without statements, so a part left empty is not versioned: the last parts are
+# deleted once empty, one in the middle keeps its expired (and inert) statements until it is reused.
+# Returns (policies to attach: created or not yet attached, last written policy, existingTables, calls)
+def put_conditioned_policy_tables(iam, date, group, tables, attached):
+    parts, calls = get_conditioned_policy_parts(iam, group)
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+
+    packed = []
+    changed = []
+    existingTables = set()
+    for part in parts:
+        grants = dict((grantDate, set(grantTables)) for grantDate, grantTables in part['grants'].items()
+                      if grantDate >= today)
+        packed.append(grants)
+        changed.append(len(grants) != len(part['grants']))
+        existingTables.update(grants.get(date, set()))
+    existingTables = sorted(existingTables)
+
+    newTables = set(tables) - set(existingTables)
+    for table in sorted(newTables):
+        for i in range(len(packed)):
+            candidate = dict(packed[i])
+            candidate[date] = candidate.get(date, set()) | {table}
+            if len(serialize_policy_document(build_conditioned_policy_document(candidate))) <= POLICY_SIZE_LIMIT:
+                packed[i] = candidate
+                changed[i] = True
+                break
+        else:
+            if len(serialize_policy_document(build_conditioned_policy_document({date: {table}}))) > POLICY_SIZE_LIMIT:
+                raise ValueError('Table name %s is too long to fit in a policy' % table)
+            packed.append({date: {table}})
+            changed.append(True)
+
+    if len(packed) > MAX_POLICY_PARTS:
+        raise ValueError('%d tables need %d policies, more than the limit of %d' %
+                         (len(existingTables) + len(newTables), len(packed), MAX_POLICY_PARTS))
+
+    # parts are looked up by number until the first missing one, so only trailing parts can go
+    while packed and not packed[-1] and len(packed) <= len(parts):
+        calls += delete_conditioned_policy(iam, parts[len(packed) - 1]['arn'])
+        attached = attached - {parts[len(packed) - 1]['arn']}
+        packed.pop()
+    unattached = get_unattached_parts(group, parts, len(packed), attached)
+
+    created = []
+    policy = parts[0]['policy'] if parts else None
+    for i, grants in enumerate(packed):
+        if not changed[i] or not grants:
+            continue
+        document = serialize_policy_document(build_conditioned_policy_document(grants))
+        if i < len(parts):
+            policy, versionCalls = put_policy_version(iam, parts[i]['arn'], document)
+            calls += versionCalls
+        else:
+            calls += 1
+            policy = iam.create_policy(
+                PolicyName=get_conditioned_policy_name(group, i + 1),
+                PolicyDocument=document
             )
+            created.append(policy)
+    return created + unattached, policy, existingTables, calls
+
+
+# if the provided table exists, create or up-issue the policies of the grant.
+# otherwise, just return a template of the policy
+def create_policy(iam, tableList, date, group, tableExistFlag=False):
+    created = []
+    existingAccess = ''
+
+    if tableExistFlag:
+        attached = get_attached_policy_arns(iam, group)
+        if POLICY_MODE == 'conditioned':
+            created, policy, existingTables, calls = put_conditioned_policy_tables(iam, date, group, tableList, attached)
+        else:
+            created, policy, existingTables, calls = put_policy_tables(iam, date, group, tableList, attached)
+        calls += 1
+        existingAccess = "\n".join(existingTables)
+        print('%s-%s: %d IAM call%s for this grant' % (date, group, calls, 's' if calls > 1 else ''))
         print(policy)
     else:
-        policy = policy_template
+        policy = build_policy_document(tableList)
+        print(json.dumps(policy))
 
-    return (status, policy, existingAccess)
+    return (created, policy, existingAccess)
 
 
 # if policy is create or already exist then attach to the group or user
@@ -162,71 +463,157 @@ def attach_policy(iam, policy_created, group):
             GroupName=group,
             PolicyArn=policy_created['Policy']['Arn']
         )
-    except botocore.errorfactory.ClientError:
-
-        Iam_Attach_policy = iam.attach_user_policy(
-            UserName=group,
-            PolicyArn=policy_created['Policy']['Arn']
-        )
-    except botocore.errorfactory.ClientError:
-        return False  # should never reach this statement
+    except botocore.errorfactory.ClientError as e:
+        print(e)
+        try:
+            Iam_Attach_policy = iam.attach_user_policy(
+                UserName=group,
+                PolicyArn=policy_created['Policy']['Arn']
+            )
+        except botocore.errorfactory.ClientError as e:
+            # the part stays unattached and is attached again by the next request for that date
+            print(e)
+            return False
     return Iam_Attach_policy
 
 
 # message the slack team channel as well as team-sre when policy is attached to the user or team
 def messageToSlack(table_name, group, userId, date):
     slack_channel = '#' + group.lower()
-    slack_format_table_name = ""
     notificationChannel = os.environ['notificationChannel'].split(",")
     pretext = 'READ Access has been granted to %s for the following table%s until EOD %s (requested by <@%s>):' % \
               (group, ('s' if len(table_name.split('\n')) > 1 else ''), date, userId)
 
     print(slack_channel)
 
-    slack_message = {
-        'channel': slack_channel,
-        "attachments": [
-            {
-                "fallback": "Table Access",
-                "color": "#2eb886",
-                "pretext": pretext,
-                "text": table_name
-            }
-        ]
-    }
+    channels = [slack_channel]
+    if slack_channel not in notificationChannel:
+        channels += notificationChannel
 
-    _send_slack_message(slack_message)
-
-
-    if slack_channel not in  notificationChannel:
-        for channel in notificationChannel:
-            slack_message = {
-                'channel': channel,
-                "attachments": [
-                    {
-                        "fallback": "Table Access",
-                        "color": "#2eb886",
-                        "pretext": pretext,
-                        "text": table_name
-                    }
-                ]
-            }
-            _send_slack_message(slack_message)
+    slack_messages = []
+    for channel in channels:
+        slack_messages.append({
+            'channel': channel,
+            "attachments": [
+                {
+                    "fallback": "Table Access",
+                    "color": "#2eb886",
+                    "pretext": pretext,
+                    "text": table_name
+                }
+            ]
+        })
 
+    enqueueSlackMessages(slack_messages)
+
+
+# keep-alive connection pool to the slack webhook, shared by warm invocations
+_slack_http = urllib3.PoolManager(maxsize=10, retries=False, timeout=urllib3.Timeout(connect=2.0, read=5.0))
+SLACK_RETRIES = 3
+SLACK_BACKOFF = 0.5
+# longest Retry-After honoured by sleeping. A longer one would outlast the drainer's timeout, so the
+# message goes back on the outbox with that delay instead
+SLACK_MAX_WAIT = SLACK_BACKOFF * 2 ** SLACK_RETRIES
+
+
+class SlackRetryAfter(ValueError):
+    def __init__(self, message, retryAfter):
+        ValueError.__init__(self, message)
+        self.retryAfter = retryAfter
 
-# post message format that can be sent to slack
-def _send_slack_message(slack_message):
-    response = requests.post(
-        os.environ['HookUrl'], data=json.dumps(slack_message),
-        headers={'Content-Type': 'application/json'}
-    )
 
-    if response.status_code != 200:
-        raise ValueError(
-            'Request to slack returned an error %s, the response is:\n%s'
-            % (response.status_code, response.text)
+# post message format that can be sent to slack, retrying throttled or failed requests with backoff
+def _send_slack_message(slack_message):
+    delay = SLACK_BACKOFF
+    error = None
+    for attempt in range(SLACK_RETRIES + 1):
+        try:
+            response = _slack_http.request(
+                'POST', os.environ['HookUrl'], body=json.dumps(slack_message),
+                headers={'Content-Type': 'application/json'}
+            )
+            if response.status == 200:
+                return response.status
+            error = 'Request to slack returned an error %s, the response is:\n%s' % \
+                    (response.status, response.data.decode('utf-8', 'replace'))
+            # only throttling and server errors are worth another attempt
+            if response.status != 429 and response.status < 500:
+                break
+            wait = float(response.headers.get('Retry-After', delay))
+            if wait > SLACK_MAX_WAIT:
+                raise SlackRetryAfter(error, wait)
+        except urllib3.exceptions.HTTPError as e:
+            error = 'Request to slack failed: %s' % e
+            wait = delay
+
+        if attempt < SLACK_RETRIES:
+            time.sleep(wait)
+            delay *= 2
+
+    raise ValueError(error)
+
+
+# Slack notifications are written to an outbox queue and delivered by the drainer below, so the
+# Lex response only waits for one enqueue. Without an outboxQueueUrl the in-memory outbox is
+# used instead and drained straight away (used locally and for tests)
+_local_outbox = []
+OUTBOX_MAX_ATTEMPTS = 5
+
+
+def enqueueSlackMessages(slack_messages, attempt=0, wait=0):
+    entry = {'messages': slack_messages, 'attempt': attempt}
+    queueUrl = os.environ.get('outboxQueueUrl')
+    if queueUrl:
+        getClient('sqs').send_message(
+            QueueUrl=queueUrl,
+            MessageBody=json.dumps(entry),
+            DelaySeconds=min(max(2 ** attempt, int(wait + 0.999)), 900) if attempt else 0
         )
-    return response.status_code
+    else:
+        _local_outbox.append(entry)
+        drainLocalOutbox()
+
+
+def drainLocalOutbox():
+    entries = list(_local_outbox)
+    del _local_outbox[:]
+    return deliverOutbox(entries)
+
+
+# deliver a batch of outbox entries in one concurrent fan-out. Messages that still fail after
+# the per-post retries are put back on the outbox with a delay (at least Slack's Retry-After)
+# until OUTBOX_MAX_ATTEMPTS
+def deliverOutbox(entries):
+    slack_messages = []
+    attempts = []
+    for entry in entries:
+        for message in entry['messages']:
+            slack_messages.append(message)
+            attempts.append(entry['attempt'])
+
+    result = {'sent': [], 'failed': {}}
+    with ThreadPoolExecutor(max_workers=max(1, min(len(slack_messages), 10))) as executor:
+        futures = [executor.submit(_send_slack_message, message) for message in slack_messages]
+        retry = []
+        for message, attempt, future in zip(slack_messages, attempts, futures):
+            try:
+                future.result()
+                result['sent'].append(message['channel'])
+            except ValueError as e:
+                result['failed'][message['channel']] = str(e)
+                if attempt + 1 < OUTBOX_MAX_ATTEMPTS and os.environ.get('outboxQueueUrl'):
+                    retry.append((message, attempt + 1, getattr(e, 'retryAfter', 0)))
+
+    for message, attempt, wait in retry:
+        enqueueSlackMessages([message], attempt, wait)
+    if result['failed']:
+        print('Slack notification failed for %s' % json.dumps(result['failed']))
+    return result
+
+
+# drain the SQS records delivered to the lambda by the outbox event source
+def drainOutbox(records):
+    return deliverOutbox([json.loads(record['body']) for record in records])
 
 
 def response_card_option(option_list):
@@ -263,37 +650,259 @@ def responseCard(title, subtitle, options):
     return response_card
 
 
+# Table names in the catalog are cached at module level so warm invocations (and every
+# table of a comma separated request) share one scan of its sources until the TTL expires.
+# The compiled lookup index is rebuilt together with the names.
+_table_catalog = {
+    'tables': None,
+    'index': None,
+    'version': None,
+    'listed': 0,
+    'expires': 0
+}
+
+RESOLVED_EXACT = 'exact'
+RESOLVED_AMBIGUOUS = 'ambiguous'
+RESOLVED_MISSING = 'missing'
+
+
+def get_table_arn(name):
+    account, region, table = get_table_source(name)
+    return 'arn:aws:dynamodb:' + region + ':' + account + ':table/' + table
+
+
+# drop the cached table names so the next lookup re-lists the account
+def invalidate_table_catalog():
+    _table_catalog['tables'] = None
+    _table_catalog['index'] = None
+    _table_catalog['version'] = None
+    _table_catalog['listed'] = 0
+    _table_catalog['expires'] = 0
+
+
+# return the cached list of table names, refreshing it when it is missing, expired, forced or
+# built before the given catalog version (bumped by Scotty_TableSlotUpdater on every table event)
+def get_table_catalog(client, refresh=False, version=None):
+    now = time.time()
+    if version is not None and version != _table_catalog['version']:
+        refresh = True
+    if refresh or _table_catalog['tables'] is None or now >= _table_catalog['expires']:
+        tables = list_catalog_tables(client)
+        _table_catalog['tables'] = tables
+        _table_catalog['index'] = build_table_index(tables)
+        _table_catalog['version'] = version
+        _table_catalog['listed'] = now
+        _table_catalog['expires'] = now + int(os.environ.get('catalogTTL', 300))
+    return _table_catalog['tables']
+
+
+# return the compiled index for the cached catalog
+def get_table_index(client, refresh=False, version=None):
+    get_table_catalog(client, refresh, version)
+    return _table_catalog['index']
+
+
+# compile the table names into a case-folded hash for exact hits and a sorted list of
+# reversed names, so that every table ending with a suffix sits in one contiguous range
+def build_table_index(tables):
+    exact = {}
+    for table in tables:
+        exact.setdefault(table.lower(), table)
+    return {
+        'exact': exact,
+        'reversed': sorted(table[::-1] for table in tables)
+    }
+
+
+# return every table whose name ends with the given suffix
+def find_suffix_matches(index, suffix):
+    reversed_names = index['reversed']
+    reversed_suffix = suffix[::-1]
+    matches = []
+    position = bisect.bisect_left(reversed_names, reversed_suffix)
+    while position < len(reversed_names) and reversed_names[position].startswith(reversed_suffix):
+        matches.append(reversed_names[position][::-1])
+        position += 1
+    return matches
+
+
+# entries of a blacklist row as a lower cased set. Rows are string sets; rows written by older
+# versions hold a comma joined string instead
+def get_blacklist_entries(item):
+    data = item.get('data', {})
+    if 'SS' in data:
+        entries = data['SS']
+    elif 'S' in data:
+        entries = [entry for entry in data['S'].split(',') if entry and entry != 'EMPTY']
+    else:
+        entries = []
+    return frozenset(entry.lower() for entry in entries)
+
+
+# lower cased names of the catalog tables the matcher blacklists, found in one pass over the catalog.
+# Cached until either the catalog index or the blacklist snapshot changes
+_blocked_tables = {
+    'index': None,
+    'matcher': None,
+    'tables': frozenset()
+}
+
+
+def get_blocked_tables(index, matcher):
+    if _blocked_tables['index'] is not index or _blocked_tables['matcher'] is not matcher:
+        blocked = set()
+        for name in index['exact']:
+            if is_blacklisted(matcher, name):
+                blocked.add(name)
+        _blocked_tables['index'] = index
+        _blocked_tables['matcher'] = matcher
+        _blocked_tables['tables'] = frozenset(blocked)
+    return _blocked_tables['tables']
+
+
+# The blacklist rows are read together with one BatchGetItem and cached across warm invocations.
+# Once configTTL seconds pass, only their version numbers (bumped by Scotty_Blacklist on every change)
+# are re-read, and the rows themselves only when a version moved. The table_catalog row only carries
+# the version that tells when the cached table catalog went stale
+BLACKLIST_ROWS = ('blacklist_table', 'blacklist_user')
+CATALOG_VERSION_ROW = 'table_catalog'
+CONFIG_ROWS = BLACKLIST_ROWS + (CATALOG_VERSION_ROW,)
+_config_snapshot = {
+    'versions': None,
+    'tables': compile_blacklist_matcher([]),
+    'users': frozenset(),
+    'checked': 0
+}
+
+
+# {row key: item} for the config rows, optionally projected to their key and version only
+def get_config_rows(client, versionsOnly=False):
+    tableName = os.environ['dynamoDBTable']
+    request = {'Keys': [{'key': {'S': rowName}} for rowName in CONFIG_ROWS]}
+    if versionsOnly:
+        request['ProjectionExpression'] = '#key, #version'
+        request['ExpressionAttributeNames'] = {'#key': 'key', '#version': 'version'}
+
+    rows = {}
+    pending = {tableName: request}
+    delay = 0.1
+    while pending:
+        response = client.batch_get_item(RequestItems=pending)
+        for item in response['Responses'].get(tableName, []):
+            rows[item['key']['S']] = item
+        pending = response.get('UnprocessedKeys')
+        if pending:
+            time.sleep(delay)
+            delay *= 2
+    return rows
+
+
+def get_config_versions(rows):
+    return dict((rowName, rows.get(rowName, {}).get('version', {}).get('N', '0')) for rowName in CONFIG_ROWS)
+
+
+# return the cached blacklist snapshot ('tables' as a compiled matcher, 'users' as a lower cased frozenset), revalidating it
+# against the row versions once the TTL has passed, or right away when forced
+def get_config_snapshot(client, force=False):
+    now = time.time()
+    if _config_snapshot['versions'] is not None:
+        if not force and now < _config_snapshot['checked'] + int(os.environ.get('configTTL', 60)):
+            return _config_snapshot
+        if get_config_versions(get_config_rows(client, True)) == _config_snapshot['versions']:
+            _config_snapshot['checked'] = now
+            return _config_snapshot
+
+    rows = get_config_rows(client)
+    _config_snapshot['tables'] = compile_blacklist_matcher(get_blacklist_entries(rows.get('blacklist_table', {})))
+    _config_snapshot['users'] = get_blacklist_entries(rows.get('blacklist_user', {}))
+    _config_snapshot['versions'] = get_config_versions(rows)
+    _config_snapshot['checked'] = now
+    return _config_snapshot
+
+
+# resolve every requested name in one pass against the index.
+# Returns {name: (status, value)} where status is exact (value is the table name),
+# ambiguous (value is the list of tables ending with the name) or missing (value is None)
+def resolve_tables(index, tableList, blacklist):
+    resolved = {}
+    for table_name in tableList:
+        if table_name in resolved:
+            continue
+        table = index['exact'].get(table_name.lower())
+        if table is not None and table.lower() not in blacklist:
+            resolved[table_name] = (RESOLVED_EXACT, table)
+            continue
+
+        mlist = [table for table in find_suffix_matches(index, table_name)
+                 if "STAGE" not in table and table.lower() not in blacklist]
+        if mlist:
+            resolved[table_name] = (RESOLVED_AMBIGUOUS, mlist)
+        else:
+            resolved[table_name] = (RESOLVED_MISSING, None)
+    return resolved
+
+
+def resolve_snapshot_tables(client, snapshot, tableList):
+    index = get_table_index(client, version=snapshot['versions'][CATALOG_VERSION_ROW])
+    blacklist = get_blocked_tables(index, snapshot['tables'])
+    return resolve_tables(index, tableList, blacklist)
+
+
+def has_missing_tables(resolved):
+    return any(status == RESOLVED_MISSING for status, value in resolved.values())
+
+
+# resolve all the tables of a request against the cached blacklist snapshot and catalog.
+# A missing name re-reads the versions at once, so a table created since the last check is found
+# without waiting for configTTL; a deleted table still resolves until then. Tables of other accounts
+# bump no version, so a name still missing re-lists the catalog, at most once every catalogMinAge seconds
+def resolve_table_names(tableList):
+    client = getClient('dynamodb')
+    snapshot = get_config_snapshot(client)
+    resolved = resolve_snapshot_tables(client, snapshot, tableList)
+    if has_missing_tables(resolved):
+        versions = snapshot['versions']
+        snapshot = get_config_snapshot(client, force=True)
+        if snapshot['versions'] != versions:
+            resolved = resolve_snapshot_tables(client, snapshot, tableList)
+    if has_missing_tables(resolved) and \
+            time.time() >= _table_catalog['listed'] + int(os.environ.get('catalogMinAge', 30)):
+        invalidate_table_catalog()
+        resolved = resolve_snapshot_tables(client, snapshot, tableList)
+    return resolved
+
+
+# build the response card asking the user to pick one of the partially matched tables
+def partial_match_card(table_name, mlist):
+    return responseCard("Which one of the following " + table_name + " table are you looking for?", None,
+                        response_card_option(mlist))
+
+
 # validate the table entered by the user
 def validate_table(table_name):
-    blacklist = []
-    client = boto3.client('dynamodb')
-    row = client.get_item(
-        TableName=os.environ['dynamoDBTable'],
-        Key={'key': {'S': 'blacklist_table'}})
-    if 'Item' in row:
-        blacklist = row['Item']['data']['S'].split(',')
-
-    tableExistFlag = False
-    paginator = client.get_paginator('list_tables')
-    pages = paginator.paginate()
-    mlist = []
-    partialflag = ''
-    for page in pages:
-        for table in page['TableNames']:
-            if table.lower() == table_name.lower() and table_name.lower() not in [blacklist_table.lower() for
-                                                                                  blacklist_table in blacklist]:
-                tableExistFlag = True
-            elif table.endswith(table_name) and "STAGE" not in table:
-                foundTable = table
-                if foundTable.lower() not in [blacklist_table.lower() for blacklist_table in blacklist]:
-                    mlist.append(table)
-                    partialflag = True
+    status, value = resolve_table_names([table_name])[table_name]
+    if status == RESOLVED_AMBIGUOUS:
+        return partial_match_card(table_name, value)
+    return status == RESOLVED_EXACT
+
+
+# Identity resolved by earlier turns. It is only trusted while the Lex user ID it was resolved for is unchanged,
+# and survives the end of a request so the next one in the same Lex session skips Slack and IAM
+IDENTITY_ATTRIBUTES = ('identity', 'slackId', 'slackUser', 'iamGroup')
+
+
+def get_identity_attributes(session_attributes):
+    return dict((key, session_attributes[key]) for key in IDENTITY_ATTRIBUTES if key in session_attributes)
 
-    if partialflag is True:
-        return responseCard("Which one of the following " + table_name + " table are you looking for?", None,
-                            response_card_option(mlist))
 
-    return tableExistFlag
+# Tables validated by earlier turns, kept once each in the comma terminated TableString
+def get_session_tables(session_attributes):
+    return [table for table in session_attributes.get('TableString', '').split(',') if table]
+
+
+def add_session_table(session_attributes, table):
+    if table not in get_session_tables(session_attributes):
+        session_attributes['TableString'] = session_attributes.get('TableString', '') + table + ','
 
 
 def elicit_slot(session_attributes, message, slot, slot_to_elicit, response_card=None):
@@ -333,9 +942,9 @@ def reprompt(session_attributes, message, slot):
 
 
 # send message via LEX Bot
-def message_handler(message):
+def message_handler(message, session_attributes=None):
     error_message = {
-        'sessionAttributes': {},
+        'sessionAttributes': session_attributes or {},
         "dialogAction": {
             "type": "Close",
             "fulfillmentState": "Fulfilled",
@@ -349,7 +958,7 @@ def message_handler(message):
 
 
 def denyAccess(iam, tableList, eventDate, group, userId):
-    status, denied_policy = create_policy(iam, tableList, eventDate, group, False)
+    status, denied_policy, existingAccess = create_policy(iam, tableList, eventDate, group, False)
 
     slack_message = {
         'channel': os.environ['notificationChannel'],
@@ -363,93 +972,189 @@ def denyAccess(iam, tableList, eventDate, group, userId):
             }
         ]
     }
-    _send_slack_message(slack_message)
+    enqueueSlackMessages([slack_message])
     return message_handler(
         "You are not a member of a development team. Please contact a member of Team-SRE to request access.")
 
 
-def display(iam,sc,id):
-    user = getSlackMember(sc,id)
-    group = getGroupIdentity(iam, user)
-    if group not in os.environ['GroupName']:
-        return message_handler("You are not part of a team!")
-
+# Every grant is also recorded in the grant index table (partition key: group, sort key: <date>#<table>),
+# so access lookups, duplicate detection and reporting are a single Query instead of an IAM crawl.
+# Returns {date: set of tables} for the group's grants on or after fromDate, or only on onDate
+def get_group_grants(group, fromDate=None, onDate=None):
+    values = {':group': {'S': group}}
+    if onDate:
+        condition = '#group = :group AND begins_with(#grant, :date)'
+        values[':date'] = {'S': onDate + '#'}
+    else:
+        condition = '#group = :group AND #grant >= :date'
+        values[':date'] = {'S': fromDate}
+
+    grants = {}
+    paginator = getClient('dynamodb').get_paginator('query')
+    pages = paginator.paginate(
+        TableName=os.environ['grantIndexTable'],
+        KeyConditionExpression=condition,
+        ExpressionAttributeNames={'#group': 'group', '#grant': 'grant'},
+        ExpressionAttributeValues=values,
+        ProjectionExpression='#grant'
+    )
+    for page in pages:
+        for item in page['Items']:
+            grantDate, table = item['grant']['S'].split('#', 1)
+            grants.setdefault(grantDate, set()).add(table)
+    return grants
+
+
+# epoch seconds at the end of the grant day (UTC), used as the DynamoDB TTL of the grant index items
+def get_expiry_epoch(date):
+    return calendar.timegm((datetime.strptime(date, '%Y-%m-%d') + timedelta(days=1)).timetuple())
+
+
+# write one grant index item per table of the grant, plus one expiry item per newly created policy
+# (partition key policy#<group>) that Scotty_PolicyExpiry revokes once its TTL passes
+def record_grants(group, tableList, date, userId, created=()):
+    grantedAt = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    ttl = {'N': str(get_expiry_epoch(date))}
+    requests = []
+    for table in sorted(set(tableList)):
+        requests.append({'PutRequest': {'Item': {
+            'group': {'S': group},
+            'grant': {'S': date + '#' + table},
+            'table': {'S': table},
+            'expires': {'S': date},
+            'requestedBy': {'S': userId},
+            'grantedAt': {'S': grantedAt},
+            'ttl': ttl
+        }}})
+    for policy in created:
+        requests.append({'PutRequest': {'Item': {
+            'group': {'S': 'policy#' + group},
+            'grant': {'S': policy['Policy']['PolicyName']},
+            'policyArn': {'S': policy['Policy']['Arn']},
+            'policyGroup': {'S': group},
+            'expires': {'S': date},
+            'ttl': ttl
+        }}})
+
+    client = getClient('dynamodb')
+    tableName = os.environ['grantIndexTable']
+    for start in range(0, len(requests), 25):
+        pending = {tableName: requests[start:start + 25]}
+        delay = 0.1
+        while pending:
+            response = client.batch_write_item(RequestItems=pending)
+            pending = response.get('UnprocessedItems')
+            if pending:
+                time.sleep(delay)
+                delay *= 2
+
+
+def format_table_access(group, accessByDate):
+    accessTo = ""
+    for policyDate in sorted(accessByDate):
+        existingAccess = "\n".join(sorted(accessByDate[policyDate]))
+        accessTo += group + " has access to the following table%s until EOD " % (
+            's' if len(accessByDate[policyDate]) > 1 else '') + policyDate + ":\n" + existingAccess + "\n\n"
+    return accessTo
 
-    sts_client = boto3.client('sts')
-    AccountId = sts_client.get_caller_identity()['Account']
-    Region = os.environ['AWS_REGION']
 
-    pattern = re.compile(r'\d{4}-\d{2}-\d{2}-Team-\w')
-    attachedPolicies = iam.list_attached_group_policies(
-        GroupName= group
+# fetch the grants of one attached policy as {date: set of tables}; run concurrently by display
+def get_attached_policy_grants(iam, policy):
+    getPolicy = iam.get_policy(
+        PolicyArn=policy['PolicyArn']
     )
-    accessTo = ""
+    document = get_default_policy_document(iam, getPolicy)[0]
+    if policy['PolicyName'].startswith(CONDITIONED_POLICY_PREFIX):
+        return get_grants_from_document(document)
+    # a date's grant can be split over several numbered policies
+    policyDate = policy['PolicyName'].split('-Team')[0]
+    return {policyDate: set(get_tables_from_resources(document['Statement'][0]['Resource']))}
 
-    for policy in attachedPolicies['AttachedPolicies']:
-        existingAccess = ''
-        policyDate = policy['PolicyName'].split('-Team')[0]
-        if pattern.match(policy["PolicyName"]):
-            getPolicy = iam.get_policy(
-                PolicyArn=policy['PolicyArn']
-            )
-            defaultPolicy = iam.get_policy_version(
-                PolicyArn=getPolicy['Policy']['Arn'],
-                VersionId=getPolicy['Policy']['DefaultVersionId']
-            )
 
-            currentResource = defaultPolicy['PolicyVersion']['Document']['Statement'][0]['Resource']
-            for i in range(0, len(currentResource), 2):
-                existingAccess += currentResource[i][
-                                  len('arn:aws:dynamodb:' + Region + ':' + AccountId + ':' + "table/"):] + ","
-            existingAccess = "\n".join(existingAccess.split(",")[:-1])
+def display(iam,sc,id):
+    user = getSlackMember(sc,id)
+    group = getGroupIdentity(iam, user)
+    if group not in os.environ['GroupName']:
+        return message_handler("You are not part of a team!")
 
-            accessTo += group + " has access to the following table%s until EOD " % (
-                's' if len(currentResource) / 2 > 1 else '') + policyDate + ":\n" + existingAccess + "\n\n"
+    accessByDate = {}
+    if os.environ.get('grantIndexTable'):
+        accessByDate = get_group_grants(group, fromDate=date.today().isoformat())
+    if not accessByDate:
+        # grants made before the index was deployed are only in IAM. They last at most a week,
+        # after which an empty index really means no access
+        accessByDate = get_policy_grants(iam, group)
 
+    accessTo = format_table_access(group, accessByDate)
     if accessTo == "":
         return message_handler("No access to table found!")
     else:
         return message_handler(accessTo)
 
+
+# crawl the dated and conditioned policies attached to the group. Returns {date: set of tables}
+def get_policy_grants(iam, group):
+    pattern = re.compile(r'\d{4}-\d{2}-\d{2}-Team-\w')
+    grantPolicies = []
+    paginator = iam.get_paginator('list_attached_group_policies')
+    for page in paginator.paginate(GroupName=group):
+        for policy in page['AttachedPolicies']:
+            if pattern.match(policy["PolicyName"]) or policy["PolicyName"].startswith(CONDITIONED_POLICY_PREFIX + group):
+                grantPolicies.append(policy)
+
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    accessByDate = {}
+    if grantPolicies:
+        with ThreadPoolExecutor(max_workers=min(len(grantPolicies), int(os.environ.get('policyFetchWorkers', 8)))) as executor:
+            futures = [executor.submit(get_attached_policy_grants, iam, policy) for policy in grantPolicies]
+            for future in futures:
+                for policyDate, tables in future.result().items():
+                    if policyDate >= today:
+                        accessByDate.setdefault(policyDate, set()).update(tables)
+    return accessByDate
+
+
 def lambda_handler(event, context):  # event, context
     print(json.dumps(event))
-    slack_client = SlackClient(os.environ['api_token'])
-    iam = boto3.client('iam')
-
-    # set counter
-    session_Attributes = event["sessionAttributes"]
-    if session_Attributes is None or session_Attributes == {}:
-        session_Attributes = {
-            "counter": 0,
-            "validateCounter": 0,
-            "dateCounter": 0,
-            "TableString": "",
-            "tableReprompt": "True"
-        }
-        counter = session_Attributes['counter']
-        validateCounter = session_Attributes["validateCounter"]
-        dateCounter = session_Attributes["dateCounter"]
-        tablestring = session_Attributes['TableString']
-        isReprompt = session_Attributes['tableReprompt']
-    else:
-        counter = int(session_Attributes['counter'])
-        validateCounter = int(session_Attributes["validateCounter"])
-        dateCounter = int(session_Attributes["dateCounter"])
-        tablestring = session_Attributes['TableString']
-        isReprompt = session_Attributes['tableReprompt']
+    # batches of queued slack notifications from the outbox
+    if 'Records' in event:
+        return drainOutbox(event['Records'])
+
+    slack_client = getSlackClient()
+    iam = getClient('iam')
+
+    # set counter. A session left by a finished request only holds the memoized identity
+    session_Attributes = event["sessionAttributes"] or {}
+    if session_Attributes.get('identity') != event['userId']:
+        session_Attributes = dict((key, value) for key, value in session_Attributes.items() if key not in IDENTITY_ATTRIBUTES)
+    counter = int(session_Attributes.get('counter', 0))
+    validateCounter = int(session_Attributes.get("validateCounter", 0))
+    dateCounter = int(session_Attributes.get("dateCounter", 0))
+    tablestring = session_Attributes.get('TableString', "")
+    isReprompt = session_Attributes.get('tableReprompt', "True")
+    session_Attributes.update({
+        "counter": counter,
+        "validateCounter": validateCounter,
+        "dateCounter": dateCounter,
+        "TableString": tablestring,
+        "tableReprompt": isReprompt
+    })
 
     if event['inputTranscript'].lower() == 'cancel' or event['inputTranscript'].lower() == 'abort':
         return message_handler("You have cancelled the request to access dynamoDB")
 
-    workspace_id = getSlackWorkspaceId(slack_client)
+    # Get the user that sent the command, once per conversation
+    userId = session_Attributes.get('slackId')
+    if userId is None:
+        workspace_id = getSlackWorkspaceId(slack_client)
+        userId = event['userId']
+        userId_split = userId.split(':')
 
-    # Get the user that sent the command
-    userId = event['userId']
-    userId_split = userId.split(':')
-
-    # check if they're part of the correct workspace on slack
-    if userId_split[1] == workspace_id:
-        userId = userId_split[2]
+        # check if they're part of the correct workspace on slack
+        if userId_split[1] == workspace_id:
+            userId = userId_split[2]
+        session_Attributes['identity'] = event['userId']
+        session_Attributes['slackId'] = userId
 
     if event['inputTranscript'].lower() == "show table access":
         return display(iam,slack_client, userId)
@@ -465,25 +1170,25 @@ def lambda_handler(event, context):  # event, context
             session_Attributes['counter'] = 0
             return message_handler("You have reached your attempt limit! Please try again or find a member of Team-SRE")
         elif event['inputTranscript'].lower() == 'access to' or event['inputTranscript'].lower() == 'request access to' or event['inputTranscript'].lower() == 'request access' :
-            session_Attributes = {
+            session_Attributes.update({
                 "counter": counter,
                 "validateCounter": validateCounter,
                 "dateCounter": dateCounter,
                 "TableString": tablestring,
                 "tableReprompt": isReprompt
-            }
+            })
             return elicit_slot(session_Attributes,
                                "What table would you like access to?",
                                event['currentIntent']['slots'], "table")
         else:
             counter += 1
-            session_Attributes = {
+            session_Attributes.update({
                 "counter": counter,
                 "validateCounter": validateCounter,
                 "dateCounter": dateCounter,
                 "TableString": tablestring,
                 "tableReprompt": isReprompt
-            }
+            })
             return elicit_slot(session_Attributes,
                                "Invalid table! Please enter a valid table!  " + "(" + str(
                                    3 - counter) + " attempt left)",
@@ -507,22 +1212,29 @@ def lambda_handler(event, context):  # event, context
                     event['currentIntent']['slots'], "table")
 
             table_name = event['currentIntent']['slotDetails']['table']['originalValue']
-            tableList = [stripWhiteSpace.strip() for stripWhiteSpace in table_name.split(",")]
+            # only names not already validated by an earlier turn are resolved
+            validated = set(table.lower() for table in get_session_tables(session_Attributes))
+            tableList = []
+            for stripWhiteSpace in table_name.split(","):
+                table = stripWhiteSpace.strip()
+                if table and table.lower() not in validated and table not in tableList:
+                    tableList.append(table)
+            resolvedTables = resolve_table_names(tableList) if tableList else {}
             for table in tableList:
-                table_exist = validate_table(table)
-                if type(table_exist) is dict:
+                status, table_match = resolvedTables[table]
+                if status == RESOLVED_AMBIGUOUS:
                     counter = 0
                     session_Attributes['counter'] = counter
-                    ButtonCheck = elicit_slot(session_Attributes, "Which one of these tables",
-                                              event['currentIntent']['slots'], "table", table_exist)
-                    if len(ButtonCheck['dialogAction']['responseCard']['genericAttachments'][0]['buttons']) > 5:
+                    if len(table_match) > 5:
                         return elicit_slot(session_Attributes, "Too many options. Can you be more specific?",
                                            event['currentIntent']['slots'],
                                            "table")
                     else:
-                        return ButtonCheck
+                        return elicit_slot(session_Attributes, "Which one of these tables",
+                                           event['currentIntent']['slots'], "table",
+                                           partial_match_card(table, table_match))
 
-                if table_exist is False:
+                if status == RESOLVED_MISSING:
 
                     if validateCounter == 2:
                         return message_handler(
@@ -536,7 +1248,7 @@ def lambda_handler(event, context):  # event, context
                             3 - validateCounter) + " attempt left)",
                         event['currentIntent']['slots'], "table")
 
-                session_Attributes['TableString'] += table + ","
+                add_session_table(session_Attributes, table_match)
 
                 pprint(session_Attributes['TableString'])
             if event['currentIntent']['slots']['table'] and event['currentIntent']['slots']['duration'] is None:
@@ -579,50 +1291,68 @@ def lambda_handler(event, context):  # event, context
             "The number of days you have requested is greater than 7 days! I can only give you access to tables for 7 days.")
     else:
         # get user from slack
-        user = getSlackMember(slack_client, userId)
-        client = boto3.client('dynamodb')
-        row = client.get_item(
-            TableName=os.environ['dynamoDBTable'],
-            Key={'key': {'S': 'blacklist_user'}})
-        if 'Item' in row:
-            data = row['Item']['data']['S']
-            if user in data:
-                return message_handler("You do not have permission to request access to these tables!")
+        user = session_Attributes.get('slackUser') or getSlackMember(slack_client, userId)
+        if user is not None and user.lower() in get_config_snapshot(getClient('dynamodb'))['users']:
+            return message_handler("You do not have permission to request access to these tables!")
 
         if user != None:
-            tableList = session_Attributes["TableString"].split(",")[:-1]
+            session_Attributes['slackUser'] = user
+            tableList = get_session_tables(session_Attributes)
             pprint(tableList)
             tables = '\n'.join(tableList)
             # using userID check if they are part of AWS and get their team
             # group can be a team if they are part of a team or user if they're not part of a team. if neither then it false
-            group = getGroupIdentity(iam, user)
+            group = session_Attributes.get('iamGroup') or getGroupIdentity(iam, user)
 
             if group != None:
+                session_Attributes['iamGroup'] = group
                 allowed_groups = os.environ['GroupName'].split(",")
                 # if not part of a team then access has been denied
                 if group.lower() not in [ag.lower() for ag in allowed_groups]:
                     return denyAccess(iam, tableList, eventDate, group, userId)
 
-                # create the policy or get the policy if it already exists
-                created, policy, existingTable = create_policy(iam, tableList, eventDate, group, True)
+                # every requested table already granted until that date: nothing to change in IAM
+                if os.environ.get('grantIndexTable'):
+                    granted = get_group_grants(group, onDate=eventDate).get(eventDate, set())
+                    if set(tableList) <= granted:
+                        return message_handler('%s already has READ access to the following table%s until EOD %s:\n%s' %
+                                               (group, ('s' if len(granted) > 1 else ''), eventDate,
+                                                "\n".join(sorted(granted))),
+                                               get_identity_attributes(session_Attributes))
 
-                if created:
-                    # New policy created - need to attach it
-                    is_attached = attach_policy(iam, policy, group)
+                # create the policy or get the policy if it already exists
+                try:
+                    created, policy, existingTable = create_policy(iam, tableList, eventDate, group, True)
+                except PolicyLimitError as e:
+                    print(e)
+                    return message_handler("%s has too many access policies attached! Please try again once some of the "
+                                           "current access has expired." % group, get_identity_attributes(session_Attributes))
+                except ValueError as e:
+                    print(e)
+                    return message_handler("Too many tables have been requested for one day! Please request fewer tables.",
+                                           get_identity_attributes(session_Attributes))
+
+                # New policies created - need to attach them
+                for created_policy in created:
+                    is_attached = attach_policy(iam, created_policy, group)
                     if not is_attached:
                         # error handle if the policy is not attached
                         return message_handler("Policy could not be attached!")
 
+                if os.environ.get('grantIndexTable'):
+                    # conditioned policies are never revoked, so only dated ones get an expiry item
+                    record_grants(group, tableList, eventDate, userId, created if POLICY_MODE == 'dated' else ())
+
                 # when policy is attached, send message to the team channel as well to Team_SRE
                 tables = tables.split("\n")
                 existingTable = existingTable.split('\n')
-                allTables=set(tables)| set(existingTable)
+                allTables = set(table for table in tables + existingTable if table)
                 tables = "\n".join(allTables)
                 messageToSlack(tables, group, userId, eventDate)
                 return_msg = 'READ Access has been granted to %s for the following table%s until EOD %s:\n%s' % \
                              (group, ('s' if len(tableList) > 1 else ''), eventDate, tables)
                 # send message via Lex Bot
-                return message_handler(return_msg)
+                return message_handler(return_msg, get_identity_attributes(session_Attributes))
             else:
                 message_handler("You are not part of a team")
         else:
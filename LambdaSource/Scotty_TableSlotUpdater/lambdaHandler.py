@@ -1,9 +1,66 @@
 #! python3
 import boto3
+import json
+import os
 import time
+from botocore.config import Config
 
 from pprint import pprint
 
+
+# AWS clients are created lazily once per container and reused by warm invocations
+_clients = {}
+_client_config = Config(max_pool_connections=10, retries={'max_attempts': 5})
+
+
+def getClient(service):
+    if service not in _clients:
+        _clients[service] = boto3.client(service, config=_client_config)
+    return _clients[service]
+
+
+# In freetext mode the table slot keeps whatever the user typed and Scotty_TableAccess resolves it
+# against its cached catalog, so table events only bump the catalog version and never rebuild the bot
+TABLE_SLOT_MODE = os.environ.get('tableSlotMode', 'enumerated')
+CATALOG_VERSION_ROW = 'table_catalog'
+
+# Table events are merged in Scotty_Config and applied by whichever run holds the lock
+PENDING_ROW = 'slot_pending'
+LOCK_ROW = 'slot_lock'
+DEBOUNCE_SECONDS = int(os.environ.get('debounceSeconds', 15))
+LOCK_SECONDS = int(os.environ.get('lockSeconds', 900))
+
+# Bot builds are polled with a growing interval, and handed to a new invocation before the timeout
+BOT_POLL_START = 2
+BOT_POLL_MAX = 20
+HANDOFF_MARGIN = 60
+_deadline = None
+
+
+class BuildTimeout(Exception):
+    def __init__(self, botName):
+        super(BuildTimeout, self).__init__('%s is still building' % botName)
+        self.botName = botName
+
+
+def waitForBot(lex, botName, deadline):
+    # returns the checksum once $LATEST is built, raises BuildTimeout if the deadline comes first
+    delay = BOT_POLL_START
+    while True:
+        bot = lex.get_bot(name=botName, versionOrAlias='$LATEST')
+        bot_status = bot.get('status')
+        if 'READY' in bot_status:
+            return bot.get('checksum')
+        if bot_status == 'FAILED':
+            raise ValueError('%s build failed: %s' % (botName, bot.get('failureReason')))
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise BuildTimeout(botName)
+        print('   Not ready yet...')
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, BOT_POLL_MAX)
+
+
 def updateSlot(lex, updatedSlotVersion):
     bot = lex.get_bot(
         name='Scotty',
@@ -70,19 +127,10 @@ def putbot(lex, bot, intent):
         childDirected=False,
         checksum=bot.get("checksum")
     )
-    bot_status = response.get('status')
-    checksum = response.get('checksum')
-    # Wait for BOT status to be READY
-    while 'READY' not in bot_status:
-        bot = lex.get_bot(
-            name=bot['name'],
-            versionOrAlias='$LATEST'
-        )
-        bot_status = bot.get('status')
-        checksum = bot.get('checksum')
-        print('   Not ready yet...')
-        time.sleep(5)
-    return checksum
+    if 'READY' in response.get('status'):
+        return response.get('checksum')
+    # no deadline outside of Lambda, e.g. when run by hand
+    return waitForBot(lex, bot['name'], _deadline or float('inf'))
 
 
 def publishbot(lex, bot, checksum):
@@ -94,79 +142,251 @@ def publishbot(lex, bot, checksum):
         result = True
     return result
 
-def reactToDynamoDB():
-
-    client = boto3.client("dynamodb")
-    paginator = client.get_paginator('list_tables')
-    # get all the list of table in the current environment
-    pages = paginator.paginate()
-    tablePages = []
-    for page in pages:
-        tablePages.append(page['TableNames'])
-
-    tablelist = []
-    # Creating a existing table
-    for List in tablePages:
-        for table in List:
-            tablelist.append(table)
-    # coverting the list to set
-    set_table_name = set(tablelist)
-    # pprint(set_table_name)
-    lex = boto3.client('lex-models')
+def getTableSlot(lex):
     # Getting the current slot Type for tables
-    current_slot = lex.get_slot_type(
+    return lex.get_slot_type(
         name="table",
         version="$LATEST"
     )
 
-    #  creating a set of existing table in the slot type
-    table_in_slot = set(current_slot['enumerationValues'][0]['synonyms'])
 
-    tableRemoved = len(table_in_slot - set_table_name)
-    tableAdded = len(set_table_name - table_in_slot)
+def putTableSlot(lex, current_slot, tablelist):
 
+    lex.put_slot_type(
+        name="table",
+        description="tables in dynamodb",
+        enumerationValues=[
+            {
+                "value": "table",
+                "synonyms": tablelist
+            }
+        ],
+        valueSelectionStrategy='TOP_RESOLUTION',
+        checksum=current_slot.get('checksum')
+    )
 
-    # if the number of changes in a table is greater than 0: update the current list in slot type
-    if tableRemoved is not 0 or tableAdded is not 0:
-        response = lex.put_slot_type(
-            name="table",
-            description="tables in dynamodb",
-            enumerationValues=[
-                {
-                    "value": "table",
-                    "synonyms": tablelist
-                }
-            ],
-            valueSelectionStrategy='TOP_RESOLUTION',
-            checksum=current_slot.get('checksum')
-        )
+    slot = getTableSlot(lex)
+    updatedSlotVersion = lex.create_slot_type_version(
+        name="table",
+        checksum=slot.get('checksum')
+    )['version']
+
+    if updateSlot(lex, updatedSlotVersion):
+        print("Table List has been updated!")
+    else:
+        print("The bot couldnt be updated!")
 
-        slot = lex.get_slot_type(
-            name="table",
-            version="$LATEST"
+
+def bumpCatalogVersion(client):
+    # tells the warm Scotty_TableAccess containers that their table catalog is stale
+    client.update_item(
+        TableName=os.environ['dynamoDBTable'],
+        Key={'key': {'S': CATALOG_VERSION_ROW}},
+        UpdateExpression='ADD #version :one',
+        ExpressionAttributeNames={'#version': 'version'},
+        ExpressionAttributeValues={':one': {'N': '1'}}
+    )
+
+
+def queueSlotChange(client, eventName=None, tableName=None):
+    # the last event for a table wins: a create cancels a pending delete and the other way round
+    if eventName == 'CreateTable':
+        expression = 'ADD #adds :table DELETE #removes :table'
+    elif eventName == 'DeleteTable':
+        expression = 'ADD #removes :table DELETE #adds :table'
+    else:
+        expression = 'SET #reconcile = :true'
+
+    names = {'#reconcile': 'reconcile'} if tableName is None else {'#adds': 'adds', '#removes': 'removes'}
+    values = {':true': {'BOOL': True}} if tableName is None else {':table': {'SS': [tableName]}}
+    client.update_item(
+        TableName=os.environ['dynamoDBTable'],
+        Key={'key': {'S': PENDING_ROW}},
+        UpdateExpression=expression,
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values
+    )
+
+
+def takeSlotChanges(client):
+    # read and clear the pending changes in one write, so nothing queued meanwhile is lost
+    response = client.update_item(
+        TableName=os.environ['dynamoDBTable'],
+        Key={'key': {'S': PENDING_ROW}},
+        UpdateExpression='REMOVE #adds, #removes, #reconcile',
+        ExpressionAttributeNames={'#adds': 'adds', '#removes': 'removes', '#reconcile': 'reconcile'},
+        ReturnValues='ALL_OLD'
+    )
+    item = response.get('Attributes', {})
+    adds = set(item.get('adds', {}).get('SS', []))
+    removes = set(item.get('removes', {}).get('SS', []))
+    return adds, removes, item.get('reconcile', {}).get('BOOL', False)
+
+
+def hasSlotChanges(client):
+    item = client.get_item(
+        TableName=os.environ['dynamoDBTable'],
+        Key={'key': {'S': PENDING_ROW}},
+        ConsistentRead=True
+    ).get('Item', {})
+    return any(attribute in item for attribute in ('adds', 'removes', 'reconcile'))
+
+
+def acquireSlotLock(client, owner):
+    now = int(time.time())
+    try:
+        client.put_item(
+            TableName=os.environ['dynamoDBTable'],
+            Item={
+                'key': {'S': LOCK_ROW},
+                'owner': {'S': owner},
+                'expires': {'N': str(now + LOCK_SECONDS)}
+            },
+            # the owner renews its own lease, e.g. when a build wait is continued
+            ConditionExpression='attribute_not_exists(#key) OR #expires < :now OR #owner = :owner',
+            ExpressionAttributeNames={'#key': 'key', '#expires': 'expires', '#owner': 'owner'},
+            ExpressionAttributeValues={':now': {'N': str(now)}, ':owner': {'S': owner}}
+        )
+        return True
+    except client.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def releaseSlotLock(client, owner):
+    try:
+        client.delete_item(
+            TableName=os.environ['dynamoDBTable'],
+            Key={'key': {'S': LOCK_ROW}},
+            ConditionExpression='#owner = :owner',
+            ExpressionAttributeNames={'#owner': 'owner'},
+            ExpressionAttributeValues={':owner': {'S': owner}}
         )
-        updatedSlotVersion = lex.create_slot_type_version(
-            name="table",
-            checksum=slot.get('checksum')
-        )['version']
-
-        if updateSlot(lex, updatedSlotVersion):
-            print("Table List has been updated!")
-        else:
-            print("The bot couldnt be updated!")
+    except client.exceptions.ConditionalCheckFailedException:
+        # the lease ran out and another run has taken the lock over
+        pass
+
+
+def listTables():
+    client = getClient("dynamodb")
+    paginator = client.get_paginator('list_tables')
+    # get all the list of table in the current environment
+    tablelist = []
+    for page in paginator.paginate():
+        tablelist.extend(page['TableNames'])
+    return tablelist
+
+
+def applySlotChanges(adds, removes, reconcile):
+
+    lex = getClient('lex-models')
+    current_slot = getTableSlot(lex)
+    if current_slot.get('valueSelectionStrategy') == 'ORIGINAL_VALUE':
+        # the bot was deployed with --table-slot-mode freetext: rewriting the values would undo it
+        print('ERROR: the table slot type is in freetext mode but tableSlotMode is %s, no change was made. '
+              'Deploy this function with tableSlotMode=freetext' % TABLE_SLOT_MODE)
+        return
+    table_in_slot = current_slot['enumerationValues'][0]['synonyms']
+
+    if reconcile:
+        tablelist = listTables()
+    else:
+        tablelist = [table for table in table_in_slot if table not in removes]
+        tablelist.extend(sorted(adds - set(table_in_slot)))
+
+    # if the number of changes in a table is greater than 0: update the current list in slot type
+    if set(tablelist) != set(table_in_slot):
+        putTableSlot(lex, current_slot, tablelist)
     else:
         print("No change were made to the slots")
 
 
+def continueSlotChanges(functionName, owner, botName):
+    # the lock stays with this owner, the new invocation finishes the build and carries on
+    print('Handing the %s build over to a new invocation' % botName)
+    getClient('lambda').invoke(
+        FunctionName=functionName,
+        InvocationType='Event',
+        Payload=json.dumps({'continuation': 'waitForBot', 'owner': owner, 'botName': botName})
+    )
+
+
+def processSlotChanges(owner, functionName=None, resumeBot=None):
+
+    client = getClient('dynamodb')
+    while acquireSlotLock(client, owner):
+        try:
+            if resumeBot:
+                lex = getClient('lex-models')
+                if publishbot(lex, {'name': resumeBot}, waitForBot(lex, resumeBot, _deadline or float('inf'))):
+                    print("Table List has been updated!")
+                else:
+                    print("The bot couldnt be updated!")
+                resumeBot = None
+            else:
+                # give the rest of a burst time to arrive before taking the changes
+                time.sleep(DEBOUNCE_SECONDS)
+            while True:
+                adds, removes, reconcile = takeSlotChanges(client)
+                if not (adds or removes or reconcile):
+                    break
+                print('Applying {} added and {} removed tables{}'.format(
+                    len(adds), len(removes), ' with a full reconcile' if reconcile else ''))
+                applySlotChanges(adds, removes, reconcile)
+        except BuildTimeout as e:
+            if functionName is None:
+                releaseSlotLock(client, owner)
+                raise
+            try:
+                continueSlotChanges(functionName, owner, e.botName)
+            except Exception:
+                # nobody picks the lock up without the hand-off, don't leave it held until the lease runs out
+                releaseSlotLock(client, owner)
+                raise
+            return
+        except Exception:
+            releaseSlotLock(client, owner)
+            raise
+        releaseSlotLock(client, owner)
+
+        # a change queued between the last take and the release found the lock held, pick it up here
+        if not hasSlotChanges(client):
+            return
+    print('Another run holds the slot lock, the changes are left for it')
+
+
+def reactToDynamoDB():
+    applySlotChanges(set(), set(), True)
+
 
 # Updating the existing slot if the any changes has occured in Dynamo DB
 def lambda_handler(event, context):  # event, context
 
-
-    if event['detail']['eventName'] in ['CreateTable','DeleteTable']:
-        reactToDynamoDB()
+    global _deadline
+    _deadline = time.time() + context.get_remaining_time_in_millis() / 1000.0 - HANDOFF_MARGIN
+
+    detail = event.get('detail') or {}
+    client = getClient('dynamodb')
+    if event.get('continuation') == 'waitForBot':
+        processSlotChanges(event['owner'], context.function_name, event['botName'])
+        return
+    elif event.get('detail-type') == 'Scheduled Event':
+        bumpCatalogVersion(client)
+        if TABLE_SLOT_MODE == 'freetext':
+            return
+        # nightly reconcile against the full table list
+        queueSlotChange(client)
+    elif detail.get('eventName') in ['CreateTable', 'DeleteTable'] and 'errorCode' not in detail:
+        bumpCatalogVersion(client)
+        if TABLE_SLOT_MODE == 'freetext':
+            print('Table catalog marked as changed')
+            return
+        tableName = (detail.get('requestParameters') or {}).get('tableName')
+        queueSlotChange(client, detail['eventName'] if tableName else None, tableName)
     else:
         print('No updates!')
+        return
+
+    processSlotChanges(context.aws_request_id, context.function_name)
 
 if __name__ == "__main__":
     reactToDynamoDB()
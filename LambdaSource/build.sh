@@ -0,0 +1,18 @@
+#!/bin/sh
+# Assemble <function>/build, the CodeUri of every template: the handler, the modules shared
+# through common/ and the function's requirements. Builds every Scotty function when none is given
+set -e
+cd "$(dirname "$0")"
+
+if [ $# -eq 0 ]; then
+    set -- Scotty_*
+fi
+
+for function in "$@"; do
+    rm -rf "$function/build"
+    mkdir -p "$function/build"
+    cp "$function"/*.py common/*.py "$function/build/"
+    if [ -f "$function/requirements.txt" ]; then
+        pip install -r "$function/requirements.txt" -t "$function/build"
+    fi
+done
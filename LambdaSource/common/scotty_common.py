@@ -0,0 +1,295 @@
+import boto3
+import botocore.errorfactory
+import os
+import re
+import time
+import zlib
+import fnmatch
+import calendar
+import threading
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+
+
+# AWS and Slack clients are created lazily once per container and reused by warm
+# invocations, so their connection pools survive between requests. boto3's default session is
+# not thread-safe, so clients are only ever created under _client_lock
+_clients = {}
+_client_config = Config(max_pool_connections=20, retries={'max_attempts': 5})
+_client_lock = threading.RLock()
+
+
+def getClient(service):
+    with _client_lock:
+        if service not in _clients:
+            _clients[service] = boto3.client(service, config=_client_config)
+        return _clients[service]
+
+
+def getSlackClient():
+    with _client_lock:
+        if 'slack' not in _clients:
+            # imported here so that the functions that never talk to Slack don't have to package slackclient
+            from slackclient import SlackClient
+            _clients['slack'] = SlackClient(os.environ['api_token'])
+        return _clients['slack']
+
+
+# account ID, region and ARN prefixes resolved once per container
+_account_context = {}
+
+
+def getAccountContext():
+    with _client_lock:
+        if not _account_context:
+            AccountId = getClient('sts').get_caller_identity()['Account']
+            Region = os.environ['AWS_REGION']
+            _account_context['AccountId'] = AccountId
+            _account_context['Region'] = Region
+            _account_context['PolicyArnPrefix'] = 'arn:aws:iam::' + AccountId + ':policy/'
+        return _account_context
+
+
+# the workspace never changes for a deployed bot, so it is only asked for once per container
+_slack_workspace = {}
+
+
+def getSlackWorkspaceId(slack_client):
+    if 'id' not in _slack_workspace:
+        response = slack_client.api_call("team.info")
+        # pprint(response)
+        if 'team' not in response:
+            return None
+        _slack_workspace['id'] = response['team']['id']
+    return _slack_workspace['id']
+
+
+# Slack ID -> username directory refreshed by Scotty_SlackDirectory into the config table. It is split over
+# the rows slack_directory#00..NN by crc32 of the Slack ID, so no row nears DynamoDB's 400 KB item limit.
+# Shards are kept in memory across warm invocations so lookups normally cost no Slack API call
+DIRECTORY_KEY = 'slack_directory'
+DIRECTORY_SHARDS = int(os.environ.get('directoryShards', 16))
+_slack_directory = {}
+
+
+def getDirectoryShard(userId):
+    return DIRECTORY_KEY + '#%02d' % (zlib.crc32(userId.encode('utf-8')) % DIRECTORY_SHARDS)
+
+
+# return the cached directory shard holding the user, re-reading it from the config table once the TTL expires
+def getSlackDirectory(client, userId):
+    shard = getDirectoryShard(userId)
+    now = time.time()
+    cached = _slack_directory.get(shard)
+    if cached is None or now >= cached['expires']:
+        members = {}
+        row = client.get_item(
+            TableName=os.environ['dynamoDBTable'],
+            Key={'key': {'S': shard}})
+        if 'Item' in row:
+            members = {id: value['S'] for id, value in row['Item'].get('data', {}).get('M', {}).items()}
+        cached = {'members': members, 'expires': now + int(os.environ.get('directoryTTL', 900))}
+        _slack_directory[shard] = cached
+    return cached['members']
+
+
+# lazily walk users.list one page at a time, following response_metadata.next_cursor,
+# so callers can stop as soon as they find what they are looking for
+def iterSlackMembers(slack_client, pageSize=200):
+    cursor = None
+    while True:
+        if cursor:
+            response = slack_client.api_call("users.list", limit=pageSize, cursor=cursor)
+        else:
+            response = slack_client.api_call("users.list", limit=pageSize)
+        if not response.get('ok', False):
+            raise ValueError('users.list returned an error: %s' % response.get('error'))
+
+        for member in response.get('members', []):
+            yield member
+
+        cursor = response.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return
+
+
+# parse the username out of a slack member's email, None when the member has no email
+def getMemberUsername(member):
+    email = member.get('profile', {}).get('email')
+    if not email:
+        return None
+    return email.split('@')[0]
+
+
+# look up a single user directly in slack with users.info. If the token cannot use users.info,
+# stream the member pages instead and stop at the first page that contains the user
+def lookupSlackMember(slack_client, userId):
+    response = slack_client.api_call("users.info", user=userId)
+    if response.get('ok', False):
+        return getMemberUsername(response['user'])
+    if response.get('error') == 'user_not_found':
+        return None
+
+    for member in iterSlackMembers(slack_client):
+        if member['id'] == userId:
+            return getMemberUsername(member)
+    return None
+
+
+# This method returns the username (email prefix) of the slack user, or None if the user does not exist
+def getSlackMember(slack_client, userId):
+    members = getSlackDirectory(getClient('dynamodb'), userId)
+    if userId in members:
+        return members[userId]
+
+    user = lookupSlackMember(slack_client, userId)
+    if user is not None:
+        members[userId] = user
+    return user
+
+
+# The table catalog can span accounts and regions: catalogRoles lists roles (comma separated ARNs) assumed to
+# list the tables of other accounts, catalogRegions the regions listed in every account (AWS_REGION when
+# unset). Tables outside the Lambda's own account and region are named <account>/<region>/<table>, so the
+# name carries its source and a plain name that exists in several places resolves as ambiguous
+def get_catalog_sources():
+    regions = [region.strip() for region in os.environ.get('catalogRegions', '').split(',') if region.strip()]
+    roles = [role.strip() for role in os.environ.get('catalogRoles', '').split(',') if role.strip()]
+    return [(role, region) for role in [None] + roles for region in regions or [os.environ['AWS_REGION']]]
+
+
+def get_catalog_name(account, region, table):
+    context = getAccountContext()
+    if account == context['AccountId'] and region == context['Region']:
+        return table
+    return account + '/' + region + '/' + table
+
+
+# (account, region, table) of a catalog name
+def get_table_source(name):
+    parts = name.split('/')
+    if len(parts) == 3:
+        return parts[0], parts[1], parts[2]
+    context = getAccountContext()
+    return context['AccountId'], context['Region'], name
+
+
+# credentials of the assumed catalog roles and dynamodb clients per (role, region), both kept until
+# shortly before the credentials expire, so a refresh of the catalog normally assumes no role
+_role_credentials = {}
+_catalog_clients = {}
+
+
+def get_role_credentials(role):
+    cached = _role_credentials.get(role)
+    if cached is None or time.time() >= cached['expires']:
+        credentials = getClient('sts').assume_role(
+            RoleArn=role,
+            RoleSessionName=os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'Scotty')
+        )['Credentials']
+        expires = calendar.timegm(credentials['Expiration'].utctimetuple()) - 300
+        cached = {'credentials': credentials, 'expires': expires}
+        _role_credentials[role] = cached
+    return cached
+
+
+def get_catalog_client(role, region):
+    with _client_lock:
+        cached = _catalog_clients.get((role, region))
+        if cached is not None and time.time() < cached['expires']:
+            return cached['client']
+        if role is None:
+            client = boto3.client('dynamodb', region_name=region, config=_client_config)
+            expires = float('inf')
+        else:
+            assumed = get_role_credentials(role)
+            credentials = assumed['credentials']
+            client = boto3.client(
+                'dynamodb',
+                region_name=region,
+                aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'],
+                aws_session_token=credentials['SessionToken'],
+                config=_client_config
+            )
+            expires = assumed['expires']
+        _catalog_clients[(role, region)] = {'client': client, 'expires': expires}
+        return client
+
+
+def list_source_tables(client, source):
+    role, region = source
+    account = role.split(':')[4] if role else getAccountContext()['AccountId']
+    tables = []
+    paginator = client.get_paginator('list_tables')
+    for page in paginator.paginate():
+        tables.extend(get_catalog_name(account, region, table) for table in page['TableNames'])
+    return tables
+
+
+def _log_source_error(source, error):
+    print('Could not list the tables of {} in {}: {}'.format(source[0] or 'this account', source[1], error))
+
+
+# list every source, with the given client for the Lambda's own account and region. The clients (and the
+# assumed roles) are set up one after another, only the ListTables pagination runs concurrently.
+# A source that fails is logged and left out until the next refresh
+def list_catalog_tables(client):
+    sources = get_catalog_sources()
+    if sources == [(None, os.environ['AWS_REGION'])]:
+        return list_source_tables(client, sources[0])
+
+    getAccountContext()
+    clients = []
+    for source in sources:
+        if source == (None, os.environ['AWS_REGION']):
+            clients.append((source, client))
+            continue
+        try:
+            clients.append((source, get_catalog_client(*source)))
+        except botocore.errorfactory.ClientError as e:
+            _log_source_error(source, e)
+
+    def list_source(entry):
+        source, sourceClient = entry
+        try:
+            return list_source_tables(sourceClient, source)
+        except botocore.errorfactory.ClientError as e:
+            _log_source_error(source, e)
+            return []
+
+    tables = []
+    with ThreadPoolExecutor(max_workers=min(len(clients), int(os.environ.get('catalogWorkers', 8)))) as executor:
+        for sourceTables in executor.map(list_source, clients):
+            tables.extend(sourceTables)
+    return tables
+
+
+def is_blacklist_pattern(entry):
+    return '*' in entry or '?' in entry
+
+
+# the table blacklist holds plain names and glob patterns (e.g. *-pii, prod-billing-*). It is compiled
+# once: plain names into a lower cased set, every pattern into one combined regular expression
+def compile_blacklist_matcher(entries):
+    exact = set()
+    patterns = []
+    for entry in entries:
+        if is_blacklist_pattern(entry):
+            patterns.append(fnmatch.translate(entry.lower()))
+        else:
+            exact.add(entry.lower())
+    return {
+        'exact': frozenset(exact),
+        'pattern': re.compile('|'.join(patterns), re.IGNORECASE) if patterns else None
+    }
+
+
+# entries and patterns are tried on both the catalog name and the bare table name, so blacklisting orders
+# also covers <account>/<region>/orders, while a qualified entry only covers that one source
+def is_blacklisted(matcher, name):
+    table = get_table_source(name)[2]
+    if name.lower() in matcher['exact'] or table.lower() in matcher['exact']:
+        return True
+    pattern = matcher['pattern']
+    return pattern is not None and (pattern.match(name) is not None or pattern.match(table) is not None)
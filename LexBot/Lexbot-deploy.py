@@ -1,9 +1,15 @@
 import boto3
 import argparse
+import hashlib
 import json
 import time
 import os
+import random
+import sys
 import botocore.errorfactory
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
 
 
 def _bot_exists(lex_client, bot_name):
@@ -40,7 +46,105 @@ def _slot_exists(lex_client, slot_name):
     return return_value
 
 
-def putSlot(client, slot_name, slot_description, slot_values):
+# Lex control plane errors worth another attempt after backing off
+RETRYABLE_ERRORS = ('TooManyRequestsException', 'ThrottlingException', 'LimitExceededException', 'ConflictException')
+MAX_ATTEMPTS = 6
+RETRY_BASE = 1.0
+RETRY_CAP = 20.0
+
+
+def with_retries(task):
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return task()
+        except botocore.errorfactory.ClientError as e:
+            if e.response['Error']['Code'] not in RETRYABLE_ERRORS or attempt == MAX_ATTEMPTS - 1:
+                raise
+            # full jitter, so parallel nodes that were throttled together don't retry together
+            time.sleep(random.uniform(0, min(RETRY_CAP, RETRY_BASE * 2 ** attempt)))
+
+
+def run_graph(nodes, workers):
+    """Runs {name: (dependencies, task)} on a bounded pool, each node once all of its dependencies succeeded.
+
+    Returns the results of the nodes that succeeded and the names of the nodes that failed or were skipped.
+    """
+    pending = dict(nodes)
+    running = {}
+    results = {}
+    failed = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            scheduled = True
+            while scheduled:
+                scheduled = False
+                for name, (dependencies, task) in list(pending.items()):
+                    if any(dependency in failed for dependency in dependencies):
+                        print('Skipping %s - a dependency failed' % name)
+                        failed.add(name)
+                    elif all(dependency in results for dependency in dependencies):
+                        running[executor.submit(with_retries, task)] = name
+                    else:
+                        continue
+                    del pending[name]
+                    scheduled = True
+            if not running:
+                failed.update(pending)
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    print('%s failed: %s' % (name, e))
+                    failed.add(name)
+    return results, failed
+
+
+# Fields that make up a deployed definition, everything else is metadata that changes on every put
+SLOT_TYPE_FIELDS = ('description', 'enumerationValues', 'valueSelectionStrategy')
+INTENT_FIELDS = ('description', 'slots', 'sampleUtterances', 'dialogCodeHook', 'fulfillmentActivity')
+
+
+def _project(deployed, desired):
+    # keep only what the desired definition sets, so defaults filled in by Lex don't count as changes
+    if isinstance(deployed, dict) and isinstance(desired, dict):
+        return {key: _project(deployed.get(key), value) for key, value in desired.items()}
+    if isinstance(deployed, list) and isinstance(desired, list) and len(deployed) == len(desired):
+        return [_project(item, value) for item, value in zip(deployed, desired)]
+    return deployed
+
+
+def _definition_fields(definition, fields):
+    definition = {field: definition.get(field) for field in fields}
+    if 'slots' in definition:
+        definition['slots'] = sorted(definition['slots'] or [], key=lambda slot: slot['name'])
+    return definition
+
+
+def definition_hash(definition, fields, reference=None):
+    definition = _definition_fields(definition, fields)
+    if reference is not None:
+        definition = _project(definition, _definition_fields(reference, fields))
+    content = json.dumps(definition, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def _latest_version(versions_call, key, name):
+    # highest numbered version, or None when only $LATEST exists
+    versions = []
+    response = versions_call(name=name)
+    versions.extend(response.get(key, []))
+    while 'nextToken' in response:
+        response = versions_call(name=name, nextToken=response['nextToken'])
+        versions.extend(response.get(key, []))
+    numbered = [int(item['version']) for item in versions if item['version'].isdigit()]
+    return str(max(numbered)) if numbered else None
+
+
+# values_managed: the values are kept up to date by Scotty_TableSlotUpdater, so only a strategy switch rewrites them
+def putSlot(client, slot_name, slot_description, slot_values, strategy="TOP_RESOLUTION", values_managed=False):
     result = False
     if not _slot_exists(client, slot_name):
         print('   Creating slot type %s' % slot_name)
@@ -51,15 +155,35 @@ def putSlot(client, slot_name, slot_description, slot_values):
             name=slot_name,
             description=slot_description,
             enumerationValues=slot_values,
-            valueSelectionStrategy="TOP_RESOLUTION"
+            valueSelectionStrategy=strategy
         )
         # print(str(response))
         if 'ResponseMetadata' in response:
             if response['ResponseMetadata']['HTTPStatusCode'] == 200 or response['ResponseMetadata']['HTTPStatusCode'] == 201:
                 result = True
     else:
-        # Slot already exists
+        # Slot already exists - only rewrite it when slots.json differs from $LATEST
         result = True
+        current = client.get_slot_type(name=slot_name, version="$LATEST")
+        desired = {
+            'description': slot_description,
+            'enumerationValues': slot_values,
+            'valueSelectionStrategy': strategy
+        }
+        if values_managed:
+            changed = current.get('valueSelectionStrategy') != strategy
+        else:
+            changed = (definition_hash(current, SLOT_TYPE_FIELDS, reference=desired) !=
+                       definition_hash(desired, SLOT_TYPE_FIELDS))
+        if changed:
+            print('   Updating slot type %s' % slot_name)
+            client.put_slot_type(
+                name=slot_name,
+                description=slot_description,
+                enumerationValues=slot_values,
+                valueSelectionStrategy=strategy,
+                checksum=current.get('checksum')
+            )
     return result
 
 
@@ -69,6 +193,12 @@ def createSlotTypeVersion(client, slot_name):
         name=slot_name,
         version="$LATEST"
     )
+    latest_version = _latest_version(client.get_slot_type_versions, 'slotTypes', slot_name)
+    if latest_version:
+        published = client.get_slot_type(name=slot_name, version=latest_version)
+        if definition_hash(published, SLOT_TYPE_FIELDS) == definition_hash(get_slot_type_response, SLOT_TYPE_FIELDS):
+            print("%s unchanged, keeping version %s" % (slot_name, latest_version))
+            return latest_version
     create_slot_type_version_response = client.create_slot_type_version(
         name=slot_name,
         checksum= get_slot_type_response.get('checksum')
@@ -128,7 +258,7 @@ def update_intent(lex_client, lambda_client, intent_name, slots):
         # create slot list with actual definitions instead of just names
         for slot in intent_def['slots']:
             # Get the version
-            slot_definition = slots[slot]['slot_definition']
+            slot_definition = dict(slots[slot]['slot_definition'])
             # Modify the version - if it exists
             if 'slotTypeVersion' in slot:
                 slot_definition['slotTypeVersion'] = slots[slot]['slot_version']
@@ -142,7 +272,17 @@ def update_intent(lex_client, lambda_client, intent_name, slots):
         if _intent_exists(lex_client, intent_name):
             # get the existing intent
             get_intent_response = lex_client.get_intent(name=intent_name, version="$LATEST")
-            if 'ResponseMetadata' in get_intent_response and get_intent_response['ResponseMetadata']['HTTPStatusCode'] == 200:
+            desired = {
+                'description': intent_def['description'],
+                'slots': slot_list,
+                'sampleUtterances': intent_def['sampleUtterances'],
+                'dialogCodeHook': dialog_code_hook,
+                'fulfillmentActivity': intent_def['fulfillmentActivity']
+            }
+            if definition_hash(get_intent_response, INTENT_FIELDS, desired) == definition_hash(desired, INTENT_FIELDS):
+                print('   %s unchanged' % intent_name)
+                status = True
+            elif 'ResponseMetadata' in get_intent_response and get_intent_response['ResponseMetadata']['HTTPStatusCode'] == 200:
                 checksum = get_intent_response['checksum']
                 # put-intent
                 put_intent_response = lex_client.put_intent(
@@ -173,6 +313,12 @@ def update_intent(lex_client, lambda_client, intent_name, slots):
 
 def createIntentVersion(client, intent_name):
     get_intent_response = client.get_intent(name=intent_name,version="$LATEST")
+    latest_version = _latest_version(client.get_intent_versions, 'intents', intent_name)
+    if latest_version:
+        published = client.get_intent(name=intent_name, version=latest_version)
+        if definition_hash(published, INTENT_FIELDS) == definition_hash(get_intent_response, INTENT_FIELDS):
+            print("%s unchanged, keeping version %s" % (intent_name, latest_version))
+            return latest_version
 
     create_intent_version_response = client.create_intent_version(
         name=intent_name,
@@ -183,6 +329,63 @@ def createIntentVersion(client, intent_name):
     return create_intent_version_response['version']
 
 
+def deploySlot(client, slots, slot, table_slot_mode='enumerated'):
+    slot_definition = slots[slot]['slot_definition']['description']
+    slot_values = slots[slot]['slot_enumeration_values']
+    strategy = "TOP_RESOLUTION"
+    if table_slot_mode == 'freetext' and 'slot_freetext_values' in slots[slot]:
+        # sample names only teach Lex what a table looks like, the slot keeps what the user typed
+        slot_values = slots[slot]['slot_freetext_values']
+        strategy = "ORIGINAL_VALUE"
+    # in enumerated mode the table values come from Scotty_TableSlotUpdater, not slots.json
+    values_managed = slot == 'table' and strategy == "TOP_RESOLUTION"
+    if putSlot(client, slot, slot_definition, slot_values, strategy, values_managed):
+        slots[slot]['slot_version'] = createSlotTypeVersion(client, slot)
+    return slots[slot].get('slot_version')
+
+
+def deployIntent(lex_client, lambda_client, bot_name, region, account_id, new_bot, intent_name, slots):
+    print('Creating/Updating %s intent' % intent_name)
+    if new_bot or not _intent_exists(lex_client, intent_name):
+        try:
+            addPermission(lambda_client, bot_name, intent_name, region, account_id)
+        except lambda_client.exceptions.ResourceConflictException:
+            # granted by an earlier attempt of this node
+            pass
+    if update_intent(lex_client, lambda_client, intent_name, slots):
+        return {'intentName': intent_name, 'intentVersion': createIntentVersion(lex_client, intent_name)}
+    return None
+
+
+# Bot builds are polled with a growing interval up to an overall deadline
+BOT_POLL_START = 2
+BOT_POLL_MAX = 20
+
+
+class BuildTimeout(Exception):
+    def __init__(self, botName):
+        super(BuildTimeout, self).__init__('%s is still building' % botName)
+        self.botName = botName
+
+
+def waitForBot(client, botName, deadline):
+    # returns the checksum once $LATEST is built, raises BuildTimeout if the deadline comes first
+    delay = BOT_POLL_START
+    while True:
+        bot = client.get_bot(name=botName, versionOrAlias='$LATEST')
+        bot_status = bot.get('status')
+        if 'READY' in bot_status:
+            return bot.get('checksum')
+        if bot_status == 'FAILED':
+            raise ValueError('%s build failed: %s' % (botName, bot.get('failureReason')))
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise BuildTimeout(botName)
+        print('   Not ready yet...')
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, BOT_POLL_MAX)
+
+
 def initializeBot(client, botName):
     print('Creating Bot')
     client.put_bot(
@@ -214,7 +417,7 @@ def initializeBot(client, botName):
     time.sleep(5)
 
 
-def buildBot(client, botName, intents):
+def buildBot(client, botName, intents, build_timeout=900):
     print('Building new Bot version')
     bot = client.get_bot(
         name=botName,
@@ -251,19 +454,23 @@ def buildBot(client, botName, intents):
         checksum=checksum
     )
 
-    bot_status = response.get('status')
-    checksum = response.get('checksum')
-    # Wait for BOT status to be READY
-    while 'READY' not in bot_status:
-        bot = client.get_bot(
-            name=botName,
-            versionOrAlias='$LATEST'
-        )
-        bot_status = bot.get('status')
-        checksum = bot.get('checksum')
-        print('   Not ready yet...')
-        time.sleep(5)
-    return checksum
+    if 'READY' in response.get('status'):
+        return response.get('checksum')
+    return waitForBot(client, botName, time.time() + build_timeout)
+
+
+def botUnchanged(client, botName, intents):
+    # the published bot already serves exactly these intent versions
+    latest_version = _latest_version(client.get_bot_versions, 'bots', botName)
+    if not latest_version:
+        return False
+    desired = sorted((intent['intentName'], intent['intentVersion']) for intent in intents)
+    for version in ('$LATEST', latest_version):
+        bot = client.get_bot(name=botName, versionOrAlias=version)
+        deployed = sorted((intent['intentName'], intent['intentVersion']) for intent in bot.get('intents', []))
+        if bot.get('status') != 'READY' or deployed != desired:
+            return False
+    return True
 
 
 def publishBot(client, botName, checksum):
@@ -348,16 +555,20 @@ if __name__ == "__main__":
     parser.add_argument("--name", help="The name for the Lex Bot", dest='name', required=True)
     parser.add_argument("--profile", help="The AWS profile to use", dest="profile", default=None, required=False)
     parser.add_argument("--region", help="The locale for the Lex", dest="region", required=True)
+    parser.add_argument("--build-timeout", help="Seconds to wait for the bot build", dest="build_timeout", type=int, default=900, required=False)
+    parser.add_argument("--table-slot-mode", help="enumerated lists every table in the slot type, freetext resolves tables in Scotty_TableAccess",
+                        dest="table_slot_mode", choices=['enumerated', 'freetext'], default='enumerated', required=False)
+    parser.add_argument("--workers", help="How many slots and intents to deploy at once", dest="workers", type=int, default=4, required=False)
 
     args = parser.parse_args()
 
-    intents = []
     slots = []
 
     session = boto3.session.Session(profile_name=args.profile, region_name=args.region)
-    lex_client = session.client("lex-models")
+    client_config = Config(max_pool_connections=max(10, args.workers), retries={'max_attempts': 5})
+    lex_client = session.client("lex-models", config=client_config)
     sts_client = session.client("sts")
-    lambda_client = session.client("lambda")
+    lambda_client = session.client("lambda", config=client_config)
     account_id = sts_client.get_caller_identity()['Account']
 
     new_bot = False
@@ -367,34 +578,43 @@ if __name__ == "__main__":
     with open ('slots.json', 'r') as slot_file:
         slots = json.loads(slot_file.read())
 
-    # create / update the slots
-    print('Creating/Updating slots for %s' % args.name)
+    # slot versions before the intents that use them, every intent before the bot
+    nodes = {}
     for slot in slots:
-        slot_definition = slots[slot]['slot_definition']['description']
-        slot_values = slots[slot]['slot_enumeration_values']
-        if putSlot(lex_client, slot, slot_definition, slot_values):
-            slot_version = createSlotTypeVersion(lex_client, slot)
-            slots[slot]['slot_version'] = slot_version
-
-    # Create / update the intents
-    intent_files = os.listdir('intents')
-    for filename in intent_files:
+        nodes['slot:' + slot] = ([], partial(deploySlot, lex_client, slots, slot, args.table_slot_mode))
+    for filename in os.listdir('intents'):
         intent_name = filename.split('.json')[0]
-        print('Creating/Updating %s intent' % intent_name)
-        if new_bot or not _intent_exists(lex_client, intent_name):
-            addPermission(lambda_client, args.name, intent_name, args.region, account_id)
-        if update_intent(lex_client, lambda_client, intent_name, slots):
-            intent_version = createIntentVersion(lex_client, intent_name)
-            intents.append({'intentName': intent_name, 'intentVersion': intent_version})
+        with open('intents/%s' % filename, 'r') as f:
+            intent_slots = json.loads(f.read())['slots']
+        dependencies = ['slot:' + slot for slot in intent_slots if slot in slots]
+        nodes['intent:' + intent_name] = (dependencies, partial(
+            deployIntent, lex_client, lambda_client, args.name, args.region, account_id, new_bot, intent_name, slots))
+
+    print('Creating/Updating slots and intents for %s' % args.name)
+    results, failed = run_graph(nodes, args.workers)
+    if failed:
+        print('Not building %s - failed: %s' % (args.name, ', '.join(sorted(failed))))
+        sys.exit(1)
+    intents = sorted((intent for name, intent in results.items() if name.startswith('intent:') and intent),
+                     key=lambda intent: intent['intentName'])
 
     if new_bot:
         initializeBot(lex_client, args.name)
 
-    checksum = buildBot(lex_client, args.name, intents)
-    if publishBot(lex_client, args.name, checksum):
-        createBotAlias(lex_client, args.name)
+    if not new_bot and botUnchanged(lex_client, args.name, intents):
+        print('No changes for %s - skipping the build' % args.name)
+        if not _alias_exists(lex_client, args.name, 'Prod'):
+            createBotAlias(lex_client, args.name)
     else:
-        print('Error publishing %s' % args.name)
+        try:
+            checksum = buildBot(lex_client, args.name, intents, args.build_timeout)
+        except BuildTimeout as e:
+            print('%s - the build carries on in Lex, run the deploy again to publish it' % e)
+            sys.exit(1)
+        if publishBot(lex_client, args.name, checksum):
+            createBotAlias(lex_client, args.name)
+        else:
+            print('Error publishing %s' % args.name)
 
     if new_bot:
         new_bot_message()